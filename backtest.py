@@ -0,0 +1,212 @@
+"""
+Backtesting of battery dispatch against historical prices and meter data.
+History is streamed in windows of window_hours (a day-ahead price publication by default). Every window is planned
+with EnergyOptimizer knowing the window's prices and consumption, and the state of charge at its end is carried
+forward as initial_soc of the next window. Input is read in chunks (CSV, Parquet) or sliced from arrays such as
+np.load(..., mmap_mode='r') results, so a multi-year, multi-home history never has to fit in memory.
+Independent runs, e.g. a sweep over battery parameters or several homes, run in parallel worker processes.
+
+Input columns:
+  price: import price per kWh
+  consumption: household consumption in kWh per hour
+  solar: solar production in kWh per hour (optional)
+  export_price: export price per kWh (optional, needed if max_export_power > 0)
+  home: home identifier (optional), selecting rows of one home in a multi-home dataset
+"""
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from batch import update_or_build
+
+
+COLUMNS = ['price', 'consumption', 'solar', 'export_price']
+
+
+@dataclass
+class BacktestResult:
+    """
+    Aggregates of one backtest run. Costs are what is paid for grid electricity (imports minus exports);
+    savings are baseline_cost - grid_cost, the baseline being the same home without a battery.
+    cycles is the charged energy divided by battery capacity. final_soc holds the state of charge at the
+    end of every window and infeasible_windows the windows without a feasible plan (they are skipped,
+    keeping the state of charge).
+    """
+    battery: dict
+    home: object = None
+    n_windows: int = 0
+    n_hours: int = 0
+    grid_cost: float = 0.0
+    baseline_cost: float = 0.0
+    savings: float = 0.0
+    charged_kwh: float = 0.0
+    discharged_kwh: float = 0.0
+    cycles: float = 0.0
+    final_soc: np.ndarray = field(default=None, repr=False)
+    infeasible_windows: list = field(default_factory=list)
+
+
+def _file_chunks(path, columns, chunk_rows):
+    """
+    Yields dicts column -> np.ndarray of at most chunk_rows rows read from a CSV or Parquet file.
+    """
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        parquet = pq.ParquetFile(path)
+        available = [name for name in columns if name in parquet.schema_arrow.names]
+        for batch in parquet.iter_batches(batch_size=chunk_rows, columns=available):
+            yield {name: batch.column(name).to_numpy(zero_copy_only=False) for name in available}
+    else:
+        import pandas as pd
+        with pd.read_csv(path, chunksize=chunk_rows, usecols=lambda name: name in columns) as reader:
+            for frame in reader:
+                yield {name: frame[name].to_numpy() for name in frame.columns}
+
+
+def _array_chunks(source, columns, chunk_rows):
+    """
+    Yields chunks sliced from a mapping of column -> array; memory-mapped arrays are only read slice by slice.
+    """
+    available = [name for name in columns if name in source]
+    n_rows = len(source[available[0]])
+    for start in range(0, n_rows, chunk_rows):
+        yield {name: np.asarray(source[name][start:start + chunk_rows]) for name in available}
+
+
+def iter_windows(source, window_hours=24, home=None, chunk_rows=100_000):
+    """
+    Yields consecutive windows of window_hours rows (the last one may be shorter) as dicts column -> np.ndarray.
+    source: path of a .csv or .parquet file, or a mapping of column -> array.
+    home: if given, only rows whose home column equals it are used.
+    """
+    columns = COLUMNS + ['home']
+    if isinstance(source, (str, os.PathLike)):
+        chunks = _file_chunks(os.fspath(source), columns, chunk_rows)
+    else:
+        chunks = _array_chunks(source, columns, chunk_rows)
+    buffered = []
+    n_buffered = 0
+    for chunk in chunks:
+        if home is not None:
+            if 'home' not in chunk:
+                raise ValueError('home %r given, but the input has no home column' % (home,))
+            mask = chunk.pop('home') == home
+            chunk = {name: values[mask] for name, values in chunk.items()}
+        else:
+            chunk.pop('home', None)
+        buffered.append(chunk)
+        n_buffered += len(chunk['price'])
+        if n_buffered < window_hours:
+            continue
+        data = {name: np.concatenate([c[name] for c in buffered]) for name in chunk}
+        n_full = n_buffered - n_buffered % window_hours
+        for start in range(0, n_full, window_hours):
+            yield {name: values[start:start + window_hours] for name, values in data.items()}
+        buffered = [{name: values[n_full:] for name, values in data.items()}]
+        n_buffered -= n_full
+    if n_buffered > 0:
+        yield {name: np.concatenate([c[name] for c in buffered]) for name in buffered[0]}
+
+
+def _window_devices(window, battery, initial_soc, max_import_power, max_export_power):
+    n_hours = len(window['price'])
+    export_prices = window.get('export_price', np.zeros(n_hours)) if max_export_power > 0 else None
+    devices = [
+        ('add_mains_electricity_supply', dict(name='mains', max_import_power=max_import_power,
+            import_hourly_prices=window['price'], max_export_power=max_export_power, export_hourly_prices=export_prices)),
+        ('add_fixed_consumption', dict(name='consumption', hourly_consumption=window['consumption'])),
+    ]
+    if 'solar' in window:
+        devices.append(('add_solar_production', dict(name='solar', estimated_hourly_production=window['solar'])))
+    devices.append(('add_battery', dict(battery, name='battery', initial_soc=initial_soc)))
+    return devices
+
+
+def _baseline_cost(window, max_export_power):
+    """
+    Grid cost of the window without a battery: the net consumption is imported, surplus solar exported up to
+    max_export_power and curtailed above it.
+    """
+    net = window['consumption'] - window.get('solar', 0.0)
+    cost = np.maximum(net, 0.0) @ window['price']
+    if max_export_power > 0:
+        cost += np.clip(net, -max_export_power, 0.0) @ window.get('export_price', np.zeros(len(net)))
+    return float(cost)
+
+
+def backtest(source, battery, window_hours=24, home=None, max_import_power=100.0, max_export_power=0.0,
+        backend='pulp', chunk_rows=100_000):
+    """
+    Replays history through the optimizer.
+    Args:
+      source: path of a .csv or .parquet file, or a mapping of column -> array; see the module docstring for columns.
+      battery: add_battery arguments except name; initial_soc is the state of charge at the start of the history.
+      window_hours: hours planned at once, e.g. 24 for day-ahead prices.
+      home: home to backtest in a multi-home dataset.
+      max_import_power, max_export_power: grid connection limits.
+      backend: optimizer backend, see EnergyOptimizer.
+    Windows of equal length share one model; only its data is updated between windows.
+    Returns a BacktestResult.
+    """
+    result = BacktestResult(battery=dict(battery), home=home)
+    soc = battery['initial_soc']
+    final_soc = []
+    optimizer = None
+    for index, window in enumerate(iter_windows(source, window_hours, home, chunk_rows)):
+        n_hours = len(window['price'])
+        devices = _window_devices(window, battery, soc, max_import_power, max_export_power)
+        optimizer, warm_start = update_or_build(optimizer, n_hours, devices, backend)
+        baseline_cost = _baseline_cost(window, max_export_power)
+        solve_result = optimizer.solve(warm_start=warm_start)
+        result.n_windows += 1
+        result.n_hours += n_hours
+        if not solve_result.has_solution:
+            result.infeasible_windows.append(index)
+            result.grid_cost += baseline_cost
+            result.baseline_cost += baseline_cost
+            final_soc.append(soc)
+            continue
+        series = optimizer.get_time_series()
+        result.grid_cost += float(optimizer.get_hourly_costs()['mains'].sum())
+        result.baseline_cost += baseline_cost
+        result.charged_kwh += float(series['battery']['charge_rate'].sum())
+        result.discharged_kwh -= float(series['battery']['discharge_rate'].sum())
+        soc = float(series['battery']['soc'][-1])
+        final_soc.append(soc)
+    result.savings = result.baseline_cost - result.grid_cost
+    result.cycles = result.charged_kwh / battery['capacity']
+    result.final_soc = np.array(final_soc)
+    return result
+
+
+def parameter_grid(base, **values):
+    """
+    Returns battery parameter sets combining base arguments with every combination of values,
+    e.g. parameter_grid(battery, capacity=[5, 10, 15], cost_of_cycle_kwh=[0, 1, 2]).
+    """
+    names = list(values)
+    return [dict(base, **dict(zip(names, combination))) for combination in itertools.product(*values.values())]
+
+
+def _backtest_job(job):
+    source, battery, home, kwargs = job
+    return backtest(source, battery, home=home, **kwargs)
+
+
+def sweep(source, batteries, homes=(None,), max_workers=None, **kwargs):
+    """
+    Backtests every battery parameter set (see parameter_grid) for every home. Runs are independent and
+    solved in parallel worker processes, each streaming its own input; with max_workers=1 they run in the
+    calling process. Other keyword arguments are passed to backtest.
+    Returns a list of BacktestResult, ordered by home and then by parameter set.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    jobs = [(source, battery, home, kwargs) for home in homes for battery in batteries]
+    if max_workers == 1:
+        return [_backtest_job(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_backtest_job, jobs))
@@ -0,0 +1,133 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from optim import EnergyOptimizer
+
+
+# Arguments of add_* methods that only change model data and can be updated in an already built model,
+# mapped to the update method taking them.
+DATA_ARGUMENTS = {
+    'add_battery': {'initial_soc': 'update_initial_soc'},
+    'add_mains_electricity_supply': {'import_hourly_prices': 'update_prices', 'export_hourly_prices': 'update_prices'},
+    'add_fixed_consumption': {'hourly_consumption': 'update_forecast'},
+    'add_solar_production': {'estimated_hourly_production': 'update_forecast'},
+    'add_flexible_consumption': {'min_cumulative_consuption': 'update_forecast'},
+    'add_heating_consumption': {'hourly_demand': 'update_forecast'},
+}
+
+
+def _hashable(value):
+    if np.ndim(value) > 0:
+        return tuple(np.asarray(value, dtype=np.float64).tolist())
+    return value
+
+
+def structure_key(devices):
+    """
+    Returns a key that is equal for scenarios which differ only in data arguments (see DATA_ARGUMENTS),
+    i.e. scenarios whose models can be obtained from one another with update_* methods.
+    """
+    key = []
+    for method_name, kwargs in devices:
+        data_arguments = DATA_ARGUMENTS.get(method_name, {})
+        key.append((method_name, tuple(sorted((arg, _hashable(value)) for arg, value in kwargs.items() if not arg in data_arguments))))
+    return tuple(key)
+
+
+def _update_data(optimizer, devices):
+    for method_name, kwargs in devices:
+        name = kwargs['name']
+        if method_name == 'add_battery':
+            optimizer.update_initial_soc(name, kwargs['initial_soc'])
+        elif method_name == 'add_mains_electricity_supply':
+            # Export prices of a supply without export are ignored by add_mains_electricity_supply.
+            export_hourly_prices = kwargs.get('export_hourly_prices') if kwargs.get('max_export_power', 0) > 0 else None
+            optimizer.update_prices(name, kwargs['import_hourly_prices'], export_hourly_prices)
+        else:
+            for arg in DATA_ARGUMENTS.get(method_name, {}):
+                optimizer.update_forecast(name, kwargs[arg])
+
+
+def update_or_build(optimizer, n_hours, devices, backend='pulp', step_hours=None):
+    """
+    Reuses a model for new scenario data: the data of devices (with the structure of the model, see structure_key)
+    is set in optimizer with update_* methods. A new model is built instead if optimizer is None, has another
+    number of hours, or cannot take the data.
+    Returns (optimizer, updated), updated telling whether the model was reused so that it may be solved warm.
+    """
+    if optimizer is not None and optimizer.n_hours == n_hours:
+        try:
+            _update_data(optimizer, devices)
+            return optimizer, True
+        except ValueError:
+            # The model cannot take the new data; build it anew.
+            pass
+    return EnergyOptimizer.from_devices(n_hours, devices, backend=backend, step_hours=step_hours), False
+
+
+def _solve_group(n_hours, scenarios, backend, step_hours):
+    """
+    Solves scenarios sharing one structure. The model is built once and only its data is updated between solves.
+    Returns a list of (time series, total cost) per scenario.
+    """
+    results = []
+    optimizer = None
+    for devices in scenarios:
+        optimizer, warm_start = update_or_build(optimizer, n_hours, devices, backend, step_hours)
+        optimizer.solve(warm_start=warm_start)
+        results.append((optimizer.get_time_series(), optimizer.get_total_cost()))
+    return results
+
+
+def solve_scenarios(n_hours, scenarios, backend='pulp', max_workers=None, step_hours=None):
+    """
+    Solves many independent scenarios, e.g. a fleet of homes or members of a forecast ensemble.
+    Scenarios sharing the same structure reuse one model per worker process; only their data is updated.
+    Args:
+      n_hours: number of hours of every scenario
+      scenarios: list of scenarios, each a list of device definitions (method_name, kwargs) as accepted by
+        EnergyOptimizer.from_devices, e.g. ('add_battery', {'name': 'battery', 'capacity': 15, ...})
+      backend: optimizer backend, see EnergyOptimizer
+      max_workers: number of worker processes; defaults to the number of CPUs. With 1 all scenarios are
+        solved in the calling process.
+      step_hours: time step lengths shared by all scenarios, see EnergyOptimizer
+    Returns (series, costs): series is a nested dict device -> variable -> np.ndarray of shape (scenario, hour),
+    with nan for variables a scenario does not have; costs is an np.ndarray of total costs per scenario.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    groups = {}
+    for index, devices in enumerate(scenarios):
+        groups.setdefault(structure_key(devices), []).append(index)
+
+    # Split every group into about max_workers chunks so that each chunk builds its model only once.
+    chunks = []
+    for indices in groups.values():
+        chunk_size = max(1, -(-len(indices) // max_workers))
+        for start in range(0, len(indices), chunk_size):
+            chunks.append(indices[start:start + chunk_size])
+
+    results = [None] * len(scenarios)
+    if max_workers == 1:
+        for chunk in chunks:
+            for index, result in zip(chunk, _solve_group(n_hours, [scenarios[i] for i in chunk], backend, step_hours)):
+                results[index] = result
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [(chunk, executor.submit(_solve_group, n_hours, [scenarios[i] for i in chunk], backend, step_hours)) for chunk in chunks]
+            for chunk, future in futures:
+                for index, result in zip(chunk, future.result()):
+                    results[index] = result
+
+    series = {}
+    for index, (time_series, cost) in enumerate(results):
+        for device_name, device_series in time_series.items():
+            for var_name, values in device_series.items():
+                stacked = series.setdefault(device_name, {})
+                if not var_name in stacked:
+                    stacked[var_name] = np.full((len(scenarios), n_hours), np.nan, dtype=np.float32)
+                stacked[var_name][index] = values
+    costs = np.array([cost for _, cost in results])
+    return series, costs
@@ -0,0 +1,95 @@
+"""
+Specialised solver for the most common household case: one battery, fixed consumption and an hourly tariff.
+Plans with dynamic programming over a discretised state of charge using NumPy only, so it can run on
+gateways without pulp or any LP solver installed. The result is in the format of
+EnergyOptimizer.get_time_series() for the equivalent model built with add_mains_electricity_supply,
+add_battery and add_fixed_consumption.
+"""
+import numpy as np
+
+
+def _hourly(x, n_hours, default):
+    if x is None:
+        return np.full(n_hours, default, dtype=np.float64)
+    if np.ndim(x) == 0:
+        return np.full(n_hours, x, dtype=np.float64)
+    assert len(x) == n_hours
+    return np.asarray(x, dtype=np.float64)
+
+
+def dispatch_battery(import_hourly_prices, hourly_consumption, capacity, initial_soc, efficiency,
+        max_charge_power, max_discharge_power, cost_of_cycle_kwh, final_energy_value_per_kwh,
+        min_soc=None, max_soc=None, max_import_power=np.inf, max_export_power=0, export_hourly_prices=None,
+        soc_step=0.1, step_hours=None, names=('mains', 'battery', 'consumption')):
+    """
+    Plans battery charging and discharging for hourly prices and consumption.
+    Arguments have the meaning of the add_mains_electricity_supply, add_battery and add_fixed_consumption
+    arguments of EnergyOptimizer. The state of charge is planned on a grid of soc_step kWh (plus initial_soc),
+    so the plan cost is within roughly n_hours * soc_step * price of the LP optimum; a smaller step is more
+    precise and costs quadratically more time per hour.
+    step_hours: length of the time steps in hours (scalar or per step), see EnergyOptimizer; consumption and
+      power limits are then average power per step.
+    names: names of the mains supply, battery and consumption devices in the returned dict.
+    Returns a nested dictionary of time series as np ndarray, like EnergyOptimizer.get_time_series().
+    Raises ValueError if no feasible plan exists on the grid.
+    """
+    assert max_charge_power > 0
+    assert max_discharge_power > 0
+    assert max_import_power >= 0
+    assert max_export_power >= 0
+    prices = np.asarray(import_hourly_prices, dtype=np.float64)
+    n_hours = len(prices)
+    consumption = _hourly(hourly_consumption, n_hours, 0.0)
+    assert np.all(consumption >= 0)
+    export_prices = _hourly(export_hourly_prices, n_hours, 0.0)
+    step_hours = _hourly(step_hours, n_hours, 1.0)
+    soc_lower = np.maximum(_hourly(min_soc, n_hours, 0.0), 0.0)
+    soc_upper = np.minimum(_hourly(max_soc, n_hours, capacity), capacity)
+    assert np.all(soc_lower <= soc_upper)
+
+    eps = 1e-9
+    levels = np.arange(0.0, capacity + soc_step / 2, soc_step)
+    levels[-1] = min(levels[-1], capacity)
+    # Value of the best plan reaching each state; before the first hour the only state is initial_soc.
+    value = np.zeros(1)
+    previous_levels = np.array([float(initial_soc)])
+    choices = []
+    for hour in range(n_hours):
+        # Transition from every previous state (rows) to every state at the end of this hour (columns).
+        dt = step_hours[hour]
+        delta = levels[None, :] - previous_levels[:, None]
+        charge = np.maximum(delta, 0.0) / dt
+        discharge = np.minimum(delta, 0.0) / dt
+        net = consumption[hour] + charge + discharge * efficiency
+        electricity_import = np.maximum(net, 0.0)
+        electricity_export = np.minimum(net, 0.0)
+        cost = (electricity_import * prices[hour] + electricity_export * export_prices[hour] + charge * cost_of_cycle_kwh) * dt
+        feasible = ((charge <= max_charge_power + eps) & (discharge >= -max_discharge_power - eps)
+            & (electricity_import <= max_import_power + eps) & (electricity_export >= -max_export_power - eps)
+            & (levels[None, :] >= soc_lower[hour] - eps) & (levels[None, :] <= soc_upper[hour] + eps))
+        total = np.where(feasible, value[:, None] + cost, np.inf)
+        best = np.argmin(total, axis=0)
+        value = total[best, np.arange(len(levels))]
+        choices.append(best)
+        previous_levels = levels
+    # Remaining value of energy in the battery after the last hour.
+    value = value - levels * efficiency * final_energy_value_per_kwh
+    state = int(np.argmin(value))
+    if not np.isfinite(value[state]):
+        raise ValueError("No feasible battery plan with soc_step=%g" % soc_step)
+
+    soc = np.empty(n_hours)
+    for hour in range(n_hours - 1, -1, -1):
+        soc[hour] = levels[state]
+        state = choices[hour][state]
+    delta = np.diff(soc, prepend=initial_soc)
+    charge = np.maximum(delta, 0.0) / step_hours
+    discharge = np.minimum(delta, 0.0) / step_hours
+    net = consumption + charge + discharge * efficiency
+    mains_name, battery_name, consumption_name = names
+    return {
+        mains_name: {'import': np.maximum(net, 0.0).astype(np.float32), 'export': np.minimum(net, 0.0).astype(np.float32)},
+        battery_name: {'charge_rate': charge.astype(np.float32), 'discharge_rate': discharge.astype(np.float32),
+            'soc': soc.astype(np.float32)},
+        consumption_name: {'consumption': consumption.astype(np.float32)},
+    }
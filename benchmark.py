@@ -0,0 +1,136 @@
+"""
+Benchmarks of EnergyOptimizer scaling across horizon length, time resolution and device count.
+Every measurement is appended as one JSON line to the output file, so that results of different
+versions can be compared. Runs offline with the CBC solver bundled with pulp, or with HiGHS of scipy
+for --backend scipy.
+Run as: python benchmark.py --label my-change
+"""
+import argparse
+import datetime
+import json
+import time
+import tracemalloc
+
+import numpy as np
+
+from optim import EnergyOptimizer
+
+
+# Devices in the order they are added; a model with n devices uses the first n of them.
+DEVICES = ['mains', 'consumption', 'battery', 'solar', 'ev_charging', 'heatpump',
+    'battery_2', 'solar_2', 'ev_charging_2', 'heatpump_2']
+
+
+def synthetic_profiles(n_hours, seed=0, step_hours=1.0):
+    """
+    Generates repeatable daily price, consumption, solar and heating demand profiles with some noise
+    for n_hours steps of step_hours each.
+    """
+    rng = np.random.default_rng(seed)
+    time = np.arange(n_hours) * step_hours
+    hour_of_day = time % 24
+    prices = 12 + 5 * np.sin((hour_of_day - 7) / 24 * 2 * np.pi) + rng.uniform(-2, 2, n_hours)
+    consumption = 0.8 + 0.6 * ((hour_of_day >= 17) & (hour_of_day <= 21)) + rng.uniform(0, 0.4, n_hours)
+    solar = np.clip(6 * np.sin((hour_of_day - 6) / 14 * np.pi), 0, None) * rng.uniform(0.5, 1.0, n_hours)
+    heating_demand = 1.5 + 0.5 * np.cos(hour_of_day / 24 * 2 * np.pi) + rng.uniform(0, 0.3, n_hours)
+    # Electric car has to get 30 kWh by 7:00 every day.
+    ev_demand = 30.0 * np.clip(np.floor((time - 7) / 24) + 1, 0, None)
+    return {'prices': prices, 'consumption': consumption, 'solar': solar,
+        'heating_demand': heating_demand, 'ev_demand': ev_demand}
+
+
+def build_model(n_hours, n_devices, profiles, backend='pulp', step_hours=None):
+    """
+    Builds a model of n_hours steps with the first n_devices of DEVICES.
+    """
+    assert 1 <= n_devices <= len(DEVICES)
+    optimizer = EnergyOptimizer(n_hours, backend=backend, step_hours=step_hours)
+    for name in DEVICES[:n_devices]:
+        kind = name.rsplit('_', 1)[0] if name[-1].isdigit() else name
+        if kind == 'mains':
+            optimizer.add_mains_electricity_supply(name=name, max_import_power=40, import_hourly_prices=profiles['prices'],
+                max_export_power=10, export_hourly_prices=profiles['prices'] * 0.5)
+        elif kind == 'consumption':
+            optimizer.add_fixed_consumption(name=name, hourly_consumption=profiles['consumption'])
+        elif kind == 'battery':
+            optimizer.add_battery(name=name, capacity=15, initial_soc=7, efficiency=0.95, max_charge_power=5,
+                max_discharge_power=5, cost_of_cycle_kwh=1, final_energy_value_per_kwh=12, min_soc=2)
+        elif kind == 'solar':
+            optimizer.add_solar_production(name=name, estimated_hourly_production=profiles['solar'])
+        elif kind == 'ev_charging':
+            optimizer.add_flexible_consumption(name=name, max_power=11.0, min_cumulative_consuption=profiles['ev_demand'])
+        elif kind == 'heatpump':
+            optimizer.add_heating_consumption(name=name, max_heat_power=4.0, hourly_demand=profiles['heating_demand'],
+                tol_cumul_min=-3, tol_cumul_max=3, final_energy_value_per_kwh=12)
+    return optimizer
+
+
+def measure(n_hours, n_devices, backend='pulp', memory=True, step_hours=1.0):
+    """
+    Builds and solves one model over n_hours hours in steps of step_hours. Returns a dict with model size,
+    build and solve time, peak Python memory of building and solving (the solver itself runs in a separate
+    process for pulp) and the objective value.
+    """
+    n_steps = int(round(n_hours / step_hours))
+    profiles = synthetic_profiles(n_steps, step_hours=step_hours)
+    start = time.perf_counter()
+    optimizer = build_model(n_steps, n_devices, profiles, backend, step_hours)
+    build_time = time.perf_counter() - start
+    optimizer.solve()
+    stats = optimizer.stats
+    result = {'n_hours': n_hours, 'step_hours': step_hours, 'n_steps': n_steps, 'n_devices': n_devices,
+        'backend': backend, 'n_vars': stats.n_vars,
+        'n_integer_vars': stats.n_integer_vars, 'n_constraints': stats.n_constraints, 'n_nonzeros': stats.n_nonzeros,
+        'build_time': build_time, 'translate_time': stats.translate_time, 'solve_time': stats.solve_time,
+        'status': stats.status, 'objective': optimizer.get_total_cost(), 'peak_memory_bytes': None}
+    if memory:
+        # Separate run, as tracing allocations slows down Python code.
+        tracemalloc.start()
+        build_model(n_steps, n_devices, profiles, backend, step_hours).solve()
+        result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def run_benchmark(horizons=(24, 96, 288, 576, 1000, 2000), device_counts=(1, 2, 4, 6, 10), backend='pulp',
+        memory=True, label=None, output=None, step_hours=(1.0,)):
+    """
+    Measures every combination of horizon (in hours), time step length and device count. Results are returned
+    and, if output is given, appended to it as JSON lines tagged with label, timestamp and library versions.
+    """
+    run = {'label': label, 'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'pulp_version': None, 'numpy_version': np.__version__}
+    if backend == 'pulp':
+        import pulp
+        run['pulp_version'] = pulp.__version__
+    results = []
+    for n_hours in horizons:
+        for step in step_hours:
+            for n_devices in device_counts:
+                result = dict(run, **measure(n_hours, n_devices, backend, memory, step))
+                results.append(result)
+                if output is not None:
+                    with open(output, 'a') as f:
+                        f.write(json.dumps(result) + '\n')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--horizons', type=int, nargs='+', default=[24, 96, 288, 576, 1000, 2000])
+    parser.add_argument('--steps', type=float, nargs='+', default=[1.0], help='time step lengths in hours')
+    parser.add_argument('--devices', type=int, nargs='+', default=[1, 2, 4, 6, 10])
+    parser.add_argument('--backend', default='pulp', choices=['pulp', 'scipy'])
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory measurement run')
+    parser.add_argument('--label', default=None, help='version label stored with every result')
+    parser.add_argument('--output', default='benchmark_results.jsonl')
+    args = parser.parse_args()
+
+    print(f"{'HOURS':>6} {'STEP h':>6} {'DEVICES':>7} {'VARS':>7} {'NONZEROS':>9} {'BUILD s':>9} {'SOLVE s':>9} "
+        f"{'PEAK MB':>8}  STATUS")
+    for horizon in args.horizons:
+        for row in run_benchmark([horizon], args.devices, args.backend, not args.no_memory, args.label, args.output,
+                args.steps):
+            peak = '' if row['peak_memory_bytes'] is None else f"{row['peak_memory_bytes'] / 1e6:.1f}"
+            print(f"{row['n_hours']:>6} {row['step_hours']:>6g} {row['n_devices']:>7} {row['n_vars']:>7} {row['n_nonzeros']:>9} "
+                f"{row['build_time']:>9.4f} {row['translate_time'] + row['solve_time']:>9.4f} {peak:>8}  {row['status']}")
@@ -0,0 +1,288 @@
+"""
+Planning of several homes behind one grid connection (e.g. apartments behind one transformer).
+The homes share a feeder import limit and pay a peak-power charge on the highest total feeder import of the
+month. Every home is an EnergyOptimizer model of its own devices; the homes are coupled only through the
+total import of their supplies:
+  sum over homes of (import + export)[hour] <= peak <= feeder_limit
+with peak_price * (peak - current_peak) added to the cost, current_peak being the peak already reached this month.
+
+solve() co-optimizes all homes in one model. solve_decomposed() coordinates the homes with prices instead: every
+round each home is planned on its own, in parallel worker processes, with a price adder on its imports, and a small
+master problem over the proposed plans sets the adders for the next round (Dantzig-Wolfe decomposition, the
+Lagrangian prices being the master's duals). Each round costs one solve per home plus a master problem of the
+size of the proposals, so solve time grows about linearly with the number of homes.
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+
+from optim import EnergyOptimizer, MatrixModel, SolveResult, solve_matrix_model
+
+
+@dataclass
+class DecompositionResult(SolveResult):
+    """
+    Outcome of MultiHomeOptimizer.solve_decomposed(). objective is the cost of the best plan found that keeps
+    the feeder limit, lower_bound the Lagrangian bound on the optimal cost and max_violation the largest excess of
+    the total import over feeder_limit in the returned plan (0 if it is kept).
+    """
+    lower_bound: float = np.nan
+    iterations: int = 0
+    max_violation: float = 0.0
+
+
+# Home models of the coordinating process or of a worker process, reused between iterations.
+_home_models = {}
+
+
+def _solve_home(job, models=_home_models):
+    """
+    Plans one home with a price adder on its supply. Returns (time series, cost without the adder,
+    objective with the adder, supply load, whether the home is an LP), or None if the home has no feasible plan.
+    """
+    key, n_hours, devices, step_hours, supply, adder = job
+    optimizer = models.get(key)
+    if optimizer is None:
+        optimizer = EnergyOptimizer.from_devices(n_hours, devices, backend='scipy', step_hours=step_hours)
+        models[key] = optimizer
+    kwargs = next(kwargs for method_name, kwargs in devices if kwargs['name'] == supply)
+    export_prices = None
+    if kwargs.get('max_export_power', 0) > 0:
+        export_prices = np.asarray(kwargs['export_hourly_prices'], dtype=np.float64) + adder
+    optimizer.update_prices(supply, np.asarray(kwargs['import_hourly_prices'], dtype=np.float64) + adder, export_prices)
+    result = optimizer.solve()
+    if not result.has_solution:
+        return None
+    series = optimizer.get_time_series()
+    load = series[supply]['import'].astype(np.float64) + series[supply]['export']
+    return (series, result.objective - adder @ (load * optimizer.step_hours), result.objective, load,
+        optimizer.model_type() == 'LP')
+
+
+class MultiHomeOptimizer():
+
+    def __init__(self, n_hours, homes, feeder_limit=None, peak_price=0.0, current_peak=0.0, supply='mains', step_hours=None):
+        """
+        Args:
+          n_hours: number of time steps.
+          homes: dict home -> device definitions (method_name, kwargs) as accepted by EnergyOptimizer.from_devices.
+          feeder_limit: maximal total import of all homes in kW, or None.
+          peak_price: price per kW of the monthly peak of the total import.
+          current_peak: peak of the total import reached earlier this month; only the increase above it is charged.
+          supply: name of the supply device of every home that is connected to the feeder.
+          step_hours: see EnergyOptimizer.
+        """
+        assert peak_price >= 0
+        assert feeder_limit is None or current_peak <= feeder_limit
+        self.n_hours = n_hours
+        self.homes = homes
+        self.feeder_limit = feeder_limit
+        self.peak_price = peak_price
+        self.current_peak = current_peak
+        self.supply = supply
+        self.step_hours = np.ones(n_hours) if step_hours is None else np.broadcast_to(np.asarray(step_hours, dtype=np.float64), (n_hours,))
+        self._step_hours_arg = step_hours
+        self.stats = None
+        self._home_series = None
+        self._total_cost = np.nan
+
+    def _peak_bounds(self):
+        lower = self.current_peak if self.peak_price > 0 else -np.inf
+        upper = np.inf if self.feeder_limit is None else self.feeder_limit
+        return lower, upper
+
+    def solve(self, verbose=False, solver=None):
+        """
+        Co-optimizes all homes in one model with scipy.optimize.milp (HiGHS). solver is a SolverConfig or a solver name.
+        Returns a SolveResult.
+        """
+        start = time.perf_counter()
+        models = {home: EnergyOptimizer.from_devices(self.n_hours, devices, backend='scipy', step_hours=self._step_hours_arg)
+            for home, devices in self.homes.items()}
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rows, cols, coeffs = [], [], []
+        cost, lower, upper, integrality, row_lower, row_upper = [], [], [], [], [], []
+        cost_offset = 0.0
+        n_vars = n_rows = 0
+        offsets = {}
+        supply_cols = []
+        for home, model in models.items():
+            matrix_model = model.get_matrix_model()
+            rows.append(matrix_model.rows + n_rows)
+            cols.append(matrix_model.cols + n_vars)
+            coeffs.append(matrix_model.coeffs)
+            cost.append(matrix_model.cost)
+            cost_offset += matrix_model.cost_offset
+            lower.append(matrix_model.lower)
+            upper.append(matrix_model.upper)
+            integrality.append(matrix_model.integrality)
+            row_lower.append(matrix_model.row_lower)
+            row_upper.append(matrix_model.row_upper)
+            supply = model.get_columns()[self.supply]
+            supply_cols += [supply['import'] + n_vars, supply['export'] + n_vars]
+            offsets[home] = n_vars
+            n_vars += matrix_model.n_vars
+            n_rows += matrix_model.n_rows
+        # Total import of the feeder against the peak column.
+        peak_lower, peak_upper = self._peak_bounds()
+        if self.peak_price > 0 or self.feeder_limit is not None:
+            peak = n_vars
+            n_vars += 1
+            cost.append([self.peak_price])
+            cost_offset -= self.peak_price * self.current_peak
+            lower.append([peak_lower])
+            upper.append([peak_upper])
+            integrality.append(np.zeros(1, dtype=np.uint8))
+            hours = n_rows + np.arange(self.n_hours)
+            rows += [hours] * len(supply_cols) + [hours]
+            cols += supply_cols + [np.full(self.n_hours, peak)]
+            coeffs += [np.ones(self.n_hours)] * len(supply_cols) + [-np.ones(self.n_hours)]
+            row_lower.append(np.full(self.n_hours, -np.inf))
+            row_upper.append(np.zeros(self.n_hours))
+            n_rows += self.n_hours
+        combined = MatrixModel(cost=np.concatenate(cost), cost_offset=cost_offset, lower=np.concatenate(lower),
+            upper=np.concatenate(upper), integrality=np.concatenate(integrality), rows=np.concatenate(rows),
+            cols=np.concatenate(cols), coeffs=np.concatenate(coeffs), row_lower=np.concatenate(row_lower),
+            row_upper=np.concatenate(row_upper))
+        combine_time = time.perf_counter() - start
+        solution, self.stats = solve_matrix_model(combined, solver, verbose, build_time={'homes': build_time})
+        self.stats.translate_time += combine_time
+        has_solution = solution is not None
+        if has_solution:
+            self._home_series = {}
+            for home, model in models.items():
+                model.set_solution(solution[offsets[home]:offsets[home] + model.n_vars])
+                self._home_series[home] = model.get_time_series()
+            self._total_cost = float(combined.cost @ solution + combined.cost_offset)
+        return SolveResult(status=self.stats.status, objective=self._total_cost if has_solution else np.nan,
+            solve_time=self.stats.solve_time, has_solution=has_solution)
+
+    def _master(self, proposals, penalty):
+        """
+        Solves the master problem of the price coordination: the cheapest convex combination of the plans proposed by
+        every home that keeps the total import below the peak, with penalized excess. Returns (weights per home,
+        objective, price adder per kWh, dual of the convexity row of every home, total excess).
+        """
+        from scipy.optimize import linprog
+        counts = [len(home_proposals) for home_proposals in proposals]
+        n_plans = sum(counts)
+        home_costs = np.concatenate([[plan[1] for plan in home_proposals] for home_proposals in proposals])
+        loads = np.concatenate([[plan[2] for plan in home_proposals] for home_proposals in proposals]).T
+        peak_lower, peak_upper = self._peak_bounds()
+        # Columns: plan weights, peak, excess of every hour.
+        cost = np.concatenate([home_costs, [self.peak_price], penalty * self.step_hours])
+        coupling = np.hstack([loads, -np.ones((self.n_hours, 1)), -np.eye(self.n_hours)])
+        convexity = np.zeros((len(proposals), len(cost)))
+        convexity[np.repeat(np.arange(len(proposals)), counts), np.arange(n_plans)] = 1.0
+        bounds = [(0, None)] * n_plans + [(None if np.isinf(peak_lower) else peak_lower, None if np.isinf(peak_upper) else peak_upper)] \
+            + [(0, None)] * self.n_hours
+        res = linprog(cost, A_ub=coupling, b_ub=np.zeros(self.n_hours), A_eq=convexity, b_eq=np.ones(len(proposals)),
+            bounds=bounds, method='highs')
+        assert res.status == 0, res.message
+        weights = np.split(res.x[:n_plans], np.cumsum(counts)[:-1])
+        objective = res.fun - self.peak_price * self.current_peak
+        adder = -res.ineqlin.marginals / self.step_hours
+        return weights, objective, adder, res.eqlin.marginals, float(res.x[n_plans + 1:].max())
+
+    def solve_decomposed(self, max_iterations=50, tol=1e-4, max_workers=None):
+        """
+        Coordinates separately planned homes with prices on the total import (Dantzig-Wolfe decomposition).
+        Every round each home proposes its cheapest plan for the current price adder on its imports; a small master
+        problem then finds the cheapest mix of all proposed plans per home that keeps the feeder limit, and its dual
+        prices on the total import become the next price adder.
+        Args:
+          max_iterations: maximal number of coordination rounds.
+          tol: stop when the plan is within this relative gap of the lower bound.
+          max_workers: number of worker processes planning the homes; defaults to the number of CPUs.
+            With 1 homes are planned in the calling process.
+        The plan of a home is the mix of its proposals, which is a valid plan if the home is an LP model
+        (see EnergyOptimizer.model_type). MILP homes get their most weighted proposal instead and the result is
+        then only approximate.
+        Returns a DecompositionResult.
+        """
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        start = time.perf_counter()
+        token = os.urandom(8).hex()
+        homes = list(self.homes)
+        coupled = self.peak_price > 0 or self.feeder_limit is not None
+        # Price of import above the peak in the master problem, high enough to never be paid in the optimum.
+        penalty = 100 * (self.peak_price + max(np.max(np.abs(kwargs['import_hourly_prices'])) for devices in self.homes.values()
+            for method_name, kwargs in devices if kwargs['name'] == self.supply))
+        adder = np.zeros(self.n_hours)
+        proposals = [[] for home in homes]
+        lower_bound = -np.inf
+        converged = False
+        executor = ProcessPoolExecutor(max_workers=max_workers) if max_workers > 1 else None
+        local_models = {}
+        try:
+            for iteration in range(1, max_iterations + 1):
+                jobs = [((token, home), self.n_hours, self.homes[home], self._step_hours_arg, self.supply, adder) for home in homes]
+                if executor is None:
+                    results = [_solve_home(job, local_models) for job in jobs]
+                else:
+                    results = list(executor.map(_solve_home, jobs))
+                if any(result is None for result in results):
+                    return DecompositionResult(status='Infeasible', objective=np.nan, solve_time=time.perf_counter() - start,
+                        has_solution=False, iterations=iteration)
+                if not coupled:
+                    proposals = [[(result[0], result[1], result[3])] for result in results]
+                    weights = [np.ones(1) for result in results]
+                    objective, excess, converged = sum(result[1] for result in results), 0.0, True
+                    lower_bound = objective
+                    break
+                if iteration > 1:
+                    # Lagrangian bound: every home at its cheapest plan for the current prices.
+                    lower_bound = max(lower_bound, objective + sum(result[2] - sigma for result, sigma in zip(results, convexity_duals)))
+                    if excess <= 1e-6 and objective - lower_bound <= tol * max(abs(objective), 1.0):
+                        converged = True
+                        break
+                for home_proposals, result in zip(proposals, results):
+                    home_proposals.append((result[0], result[1], result[3]))
+                weights, objective, adder, convexity_duals, excess = self._master(proposals, penalty)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        lp_homes = all(result[4] for result in results)
+        plans = []
+        for home_proposals, home_weights in zip(proposals, weights):
+            if lp_homes:
+                plans.append({name: {var_name: sum(w * plan[0][name][var_name] for w, plan in zip(home_weights, home_proposals) if w > 0)
+                    for var_name in device_series} for name, device_series in home_proposals[0][0].items()})
+            else:
+                plans.append(home_proposals[int(np.argmax(home_weights))][0])
+        self._home_series = dict(zip(homes, plans))
+        home_cost = sum(w @ [plan[1] for plan in home_proposals] for home_proposals, w in zip(proposals, weights)) if lp_homes else \
+            sum(home_proposals[int(np.argmax(w))][1] for home_proposals, w in zip(proposals, weights))
+        load = self.get_feeder_load()
+        self._total_cost = home_cost + self.peak_price * max(0.0, load.max() - self.current_peak)
+        violation = 0.0 if self.feeder_limit is None else max(0.0, load.max() - self.feeder_limit)
+        has_solution = violation <= 1e-6
+        status = 'Optimal' if has_solution and converged and lp_homes else 'Feasible' if has_solution else 'Not Solved'
+        return DecompositionResult(status=status, objective=self._total_cost, solve_time=time.perf_counter() - start,
+            has_solution=has_solution, lower_bound=lower_bound, iterations=iteration, max_violation=violation)
+
+    def get_time_series(self):
+        """
+        Returns a dictionary home -> nested dictionary of time series as returned by EnergyOptimizer.get_time_series().
+        """
+        return self._home_series
+
+    def get_feeder_load(self):
+        """
+        Returns the total import of all homes per hour (negative if they export).
+        """
+        return np.sum([series[self.supply]['import'].astype(np.float64) + series[self.supply]['export']
+            for series in self._home_series.values()], axis=0)
+
+    def get_total_cost(self):
+        """
+        Returns the total cost of all homes including the increase of the peak-power charge.
+        """
+        return self._total_cost
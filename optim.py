@@ -1,78 +1,869 @@
-import pulp
+import functools
+import inspect
+import logging
+import time
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+
 import numpy as np
 
+import storage
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SolveStats:
+    """
+    Instrumentation of the last solve. All times are in seconds.
+    """
+    status: str = 'Not Solved'
+    backend: str = 'pulp'
+    model_type: str = 'LP'
+    n_vars: int = 0
+    n_integer_vars: int = 0
+    n_constraints: int = 0
+    n_nonzeros: int = 0
+    # Time spent in add_* methods, per device name.
+    build_time: dict = field(default_factory=dict)
+    # Time spent assembling the constraint matrix and handing it over to the solver interface.
+    translate_time: float = 0.0
+    solve_time: float = 0.0
+    solver: str = ''
+
+
+@dataclass
+class SolverConfig:
+    """
+    Solver selection and limits for EnergyOptimizer.solve().
+    name: 'CBC', 'HiGHS', 'GLPK' or the name of any other pulp solver (see pulp.listSolvers()).
+      Defaults to CBC for the pulp backend and HiGHS for the scipy backend, which supports HiGHS only.
+    time_limit: wall-clock limit in seconds.
+    mip_gap: relative MIP gap at which the solver may stop.
+    threads: number of solver threads.
+    fallback_to_last_plan: if the solver returns no feasible solution (e.g. it hits the time limit first),
+      keep the solution of the previous solve instead of an empty plan.
+    Options a solver does not support are ignored with a warning.
+    """
+    name: str = None
+    time_limit: float = None
+    mip_gap: float = None
+    threads: int = None
+    fallback_to_last_plan: bool = False
+
+
+@dataclass
+class SolveResult:
+    """
+    Outcome of EnergyOptimizer.solve(). objective is nan and has_solution False if no feasible plan was found;
+    used_fallback is True if the plan of the previous solve was kept instead.
+    """
+    status: str
+    objective: float
+    solve_time: float
+    has_solution: bool
+    used_fallback: bool = False
+
+
+@dataclass
+class Sensitivity:
+    """
+    Marginal values of the solved plan (see EnergyOptimizer.get_sensitivity). All values are changes of the total
+    cost per unit increase of an input, valid while the same constraints stay binding.
+    energy_value: cost of consuming one more kWh in every hour, i.e. the dual of the energy balance.
+    soc_lower, soc_upper: dict battery -> cost change per kWh increase of the minimal / maximal soc of every hour;
+      nonzero only where the bound is binding.
+    capacity_value: dict battery -> cost saved by one more kWh of battery capacity.
+    reduced_costs: nested dict device -> variable -> reduced cost of every hour.
+    """
+    energy_value: np.ndarray
+    soc_lower: dict
+    soc_upper: dict
+    capacity_value: dict
+    reduced_costs: dict
+
+
+@dataclass
+class MatrixModel:
+    """
+    A model in matrix form (see EnergyOptimizer.get_matrix_model): minimize cost @ x + cost_offset subject to
+    row_lower <= A x <= row_upper and lower <= x <= upper, x integer where integrality is 1.
+    A is given in coordinate form by rows, cols and coeffs, without duplicate entries.
+    """
+    cost: np.ndarray
+    cost_offset: float
+    lower: np.ndarray
+    upper: np.ndarray
+    integrality: np.ndarray
+    rows: np.ndarray
+    cols: np.ndarray
+    coeffs: np.ndarray
+    row_lower: np.ndarray
+    row_upper: np.ndarray
+
+    @property
+    def n_vars(self):
+        return len(self.cost)
+
+    @property
+    def n_rows(self):
+        return len(self.row_lower)
+
+
+# Candidate pulp solvers for the solver names accepted in SolverConfig, in order of preference.
+_SOLVER_ALIASES = {'CBC': ['PULP_CBC_CMD', 'COIN_CMD'], 'HIGHS': ['HiGHS', 'HiGHS_CMD'], 'GLPK': ['GLPK_CMD', 'PYGLPK']}
+
+
+def _pulp_solver(config, verbose, warm_start):
+    """
+    Instantiates an available pulp solver for a SolverConfig, passing only options the solver supports.
+    """
+    import pulp
+    candidates = _SOLVER_ALIASES.get((config.name or 'CBC').upper(), [config.name])
+    for name in candidates:
+        solver_class = getattr(pulp, name, None)
+        if solver_class is None:
+            continue
+        options = {'msg': verbose, 'timeLimit': config.time_limit, 'gapRel': config.mip_gap, 'threads': config.threads}
+        if warm_start:
+            options['warmStart'] = True
+        parameters = inspect.signature(solver_class.__init__).parameters
+        accepts_any = any(p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters.values())
+        kwargs = {}
+        for option, value in options.items():
+            if value is None:
+                continue
+            if accepts_any or option in parameters:
+                kwargs[option] = value
+            elif option != 'warmStart':
+                logger.warning("Solver %s does not support option %s, ignoring it", name, option)
+        solver = solver_class(**kwargs)
+        if solver.available():
+            return solver
+    raise ValueError("Solver %s is not available, installed solvers: %s" % (config.name, pulp.listSolvers(onlyAvailable=True)))
+
+
+def _milp_options(config, verbose):
+    """
+    Returns scipy.optimize.milp options for a SolverConfig.
+    """
+    if not config.name is None and config.name.upper() != 'HIGHS':
+        raise ValueError("The scipy backend solves with HiGHS only, not %s" % config.name)
+    options = {'disp': verbose}
+    if not config.time_limit is None:
+        options['time_limit'] = config.time_limit
+    if not config.mip_gap is None:
+        options['mip_rel_gap'] = config.mip_gap
+    if not config.threads is None:
+        logger.warning("scipy.optimize.milp does not support option threads, ignoring it")
+    return options
+
+
+# scipy.optimize.milp status codes in terms of pulp.LpStatus.
+_SCIPY_STATUS = {0: 'Optimal', 1: 'Not Solved', 2: 'Infeasible', 3: 'Unbounded'}
+
+
+def solve_matrix_model(model, solver=None, verbose=False, build_time=None):
+    """
+    Solves a MatrixModel with scipy.optimize.milp (HiGHS), e.g. one combining the matrix models of several
+    optimizers. solver is a SolverConfig or a solver name; build_time is recorded in the returned stats.
+    Returns (solution, stats): the solution vector, or None if no feasible solution was found, and SolveStats.
+    """
+    from scipy.optimize import milp, Bounds, LinearConstraint
+    from scipy.sparse import csr_array
+    if solver is None or isinstance(solver, str):
+        solver = SolverConfig(name=solver)
+    options = _milp_options(solver, verbose)
+    start = time.perf_counter()
+    matrix = csr_array((model.coeffs, (model.rows, model.cols)), shape=(model.n_rows, model.n_vars))
+    n_integer_vars = int(np.count_nonzero(model.integrality))
+    stats = SolveStats(translate_time=time.perf_counter() - start, backend='scipy', model_type='MILP' if n_integer_vars else 'LP',
+        n_vars=model.n_vars, n_integer_vars=n_integer_vars, n_constraints=model.n_rows, n_nonzeros=matrix.nnz,
+        build_time=dict(build_time or {}), solver='HiGHS')
+    start = time.perf_counter()
+    res = milp(model.cost, integrality=model.integrality, bounds=Bounds(model.lower, model.upper),
+        constraints=LinearConstraint(matrix, model.row_lower, model.row_upper), options=options)
+    stats.solve_time = time.perf_counter() - start
+    stats.status = _SCIPY_STATUS.get(res.status, 'Undefined')
+    return res.x, stats
+
+
+def _timed_device(method):
+    """
+    Records time spent in an add_* method under the device name, and the device definition (see get_devices).
+    """
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        definition = signature.bind(self, *args, **kwargs).arguments
+        del definition['self']
+        name = definition['name']
+        start = time.perf_counter()
+        result = method(self, *args, **kwargs)
+        elapsed = time.perf_counter() - start
+        self._build_times[name] = elapsed
+        self._definitions.append((method.__name__, definition))
+        self._devices[name]['definition'] = definition
+        logger.debug("Added %s '%s' in %.6f s, model has %d variables and %d rows",
+            method.__name__[len('add_'):], name, elapsed, self.n_vars, self.n_rows)
+        return result
+    return wrapper
+
+
+def aggregate_to_steps(values, step_hours, resolution_hours=0.25):
+    """
+    Averages a series given at a fine uniform resolution (e.g. 15 minute prices or forecasts) over time steps
+    of step_hours, which must be multiples of the resolution. For example with step_hours=[0.25] * 24 + [1.0] * 18
+    the first 6 hours keep their 15 minute values and later hours get hourly averages.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    sizes = np.asarray(step_hours, dtype=np.float64) / resolution_hours
+    counts = np.rint(sizes).astype(np.int64)
+    assert np.allclose(sizes, counts) and np.all(counts > 0)
+    assert counts.sum() == len(values)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    return np.add.reduceat(values, starts) / counts
+
+
+class _PulpSeries(Mapping):
+    """
+    pulp variables of one time series by hour, as returned by the add_* methods with the pulp backend.
+    Variables are created on first access, so that models are built without importing pulp.
+    """
+
+    def __init__(self, optimizer, cols):
+        self._optimizer = optimizer
+        self._cols = cols
+
+    def __getitem__(self, hour):
+        return self._optimizer._pulp_variables()[self._cols[hour]]
+
+    def __iter__(self):
+        return iter(range(len(self._cols)))
+
+    def __len__(self):
+        return len(self._cols)
+
 
 class EnergyOptimizer():
 
-    def __init__(self, n_hours):
+    def __init__(self, n_hours, backend='pulp', step_hours=None):
         """
         Home energy optimizer that plans hourly usage of various electricity consumers and produceds
         for n_hours ahead.
+        Devices are added as blocks of a sparse constraint matrix (one block per device), so model
+        construction cost does not depend on per-hour Python expression building.
+        Args:
+          n_hours: number of time steps. With the default one hour steps this is the number of hours.
+          backend: 'pulp' translates the matrix into a pulp problem and solves it with the default
+            pulp solver (CBC); 'scipy' passes the sparse matrix directly to scipy.optimize.milp (HiGHS).
+          step_hours: length of the time steps in hours, a scalar (e.g. 0.25 for 15 minute steps) or one value
+            per step, e.g. [0.25] * 24 + [1.0] * 18 for 15 minute steps over the next 6 hours and hourly steps after that.
+            All hourly inputs (prices, consumption, production, power limits) are then given per step: prices per kWh,
+            consumption and production as average power in kW over the step, which for one hour steps is the same
+            as kWh per hour. Energies (soc, cumulative consumption) stay in kWh. Time series returned by
+            get_time_series are likewise average power per step, except soc and cumulative series.
         """
-        self.problem = pulp.LpProblem("Power_Optimization", pulp.LpMinimize)
+        assert backend in ('pulp', 'scipy')
+        # pulp problem is created at the first solve with the pulp backend and pulp variables when first used,
+        # so that models are built and stored plans load without importing pulp.
+        self.problem = None
+        self.backend = backend
         self.n_hours = n_hours
         self.hours = range(n_hours)
-        # Total cost of the period of modelling. This variable gets updated every time when
-        # consumers and producers get added to the system. This is the variable that gets
-        # minimized by the linear solver
-        self.total_cost = 0.0
-        # Variables tracking energy balance as difference devices are added. Must sum to zero.
-        self.energy_balance = [0.0 for hour in self.hours]
-        # Nested dict containing all other variables.
-        self.vars = {}    
+        # Length of every time step in hours, converting power into energy.
+        self.step_hours = np.ones(n_hours) if step_hours is None else self._get_hourly_series(step_hours)
+        assert np.all(self.step_hours > 0)
+        # Model columns. Every time series occupies n_hours consecutive columns.
+        self.n_vars = 0
+        self._lower_bounds = np.zeros(0)
+        self._upper_bounds = np.zeros(0)
+        self._integrality = np.zeros(0, dtype=np.uint8)
+        # Total cost of the period of modelling as linear coefficients of the columns plus a constant.
+        # It gets updated every time when consumers and producers get added to the system and
+        # is minimized by the solver.
+        self._cost = np.zeros(0)
+        self._cost_offset = 0.0
+        # Constraint rows row_lower <= A x <= row_upper, A stored in coordinate form. The first n_hours rows
+        # track energy balance as different devices are added. They must sum to zero.
+        self.n_rows = n_hours
+        self._row_lower = np.zeros(n_hours)
+        self._row_upper = np.zeros(n_hours)
+        self._rows = []
+        self._cols = []
+        self._coeffs = []
+        # Nested dict containing column indices of all time series.
+        self._columns = {}
+        # (device_name, var_name) of every time series in the order of their columns.
+        self._series = []
+        # Nested dict containing all other variables (pulp variables or column indices, depending on backend).
+        self.vars = {}
+        # pulp variable of every column, created on demand (see _pulp_variables).
+        self._pulp_vars = []
+        # Modelling mode of every electricity supply: 'LP' or 'MILP' (with binary direction series).
+        self.supply_modes = {}
+        # Modelling mode of every battery: 'LP' or 'MILP' (with a binary charging series).
+        self.battery_modes = {}
+        # Per device indices of the data that may be updated between solves (see update_* methods).
+        self._devices = {}
+        # Cached constraint matrix and pulp constraints, kept between solves while the model structure is unchanged.
+        self._matrix = None
+        self._matrix_blocks = 0
+        self._pulp_constraints = None
+        self._pulp_blocks = 0
+        # Solution vector, one value per column. Available after solve().
+        self._solution = None
+        self._last_feasible_solution = None
+        # Duals of the solved plan, computed on demand by get_sensitivity and what_if.
+        self._dual_cache = None
+        self._build_times = {}
+        # Arguments of every add_* call in the order of calls, kept up to date by the update_* methods.
+        self._definitions = []
+        # Instrumentation of the last solve.
+        self.stats = None
+
+    @classmethod
+    def from_devices(cls, n_hours, devices, backend='pulp', step_hours=None):
+        """
+        Builds an optimizer from a list of device definitions (method_name, kwargs), for instance
+        [('add_mains_electricity_supply', {'name': 'mains', ...}), ('add_battery', {'name': 'battery', ...})].
+        """
+        optimizer = cls(n_hours, backend=backend, step_hours=step_hours)
+        for method_name, kwargs in devices:
+            assert method_name.startswith('add_')
+            getattr(optimizer, method_name)(**kwargs)
+        return optimizer
+
+    @classmethod
+    def load(cls, file, backend='pulp'):
+        """
+        Builds an optimizer from a configuration stored with save().
+        """
+        return cls.from_devices(backend=backend, **storage.load_devices(file))
+
+    def save(self, file):
+        """
+        Stores the device configuration in the compact format of storage.save_devices.
+        """
+        storage.save_devices(file, self.n_hours, self.get_devices(), self.step_hours)
+
+    def save_plan(self, file):
+        """
+        Stores the solved plan in the compact format of storage.save_plan, to be loaded with storage.load_plan
+        without importing the optimizer.
+        """
+        storage.save_plan(file, self.get_time_series(), objective=self.get_total_cost())
+
+    def get_devices(self):
+        """
+        Returns definitions (method_name, kwargs) of all added devices, including data changed with the update_*
+        methods, so that EnergyOptimizer.from_devices(n_hours, optimizer.get_devices()) rebuilds the model.
+        """
+        return [(method_name, dict(definition)) for method_name, definition in self._definitions]
+
+    def _add_cost(self, cols, coeffs, constant=0.0):
+        self._cost[cols] += coeffs
+        self._cost_offset += constant
 
-    def _add_cost(self, cost):
-        self.total_cost = self.total_cost + cost        
+    def _add_to_energy_balance(self, cols, coeffs):
+        """
+        Adds coeffs * series to the energy balance of every hour. All hourly balances are constraint to sum to zero.
+        """
+        self._rows.append(np.arange(self.n_hours))
+        self._cols.append(cols)
+        self._coeffs.append(np.broadcast_to(np.asarray(coeffs, dtype=np.float64), (self.n_hours,)))
+
+    def _add_constraints(self, n_rows, rows, cols, coeffs, lower=-np.inf, upper=np.inf):
+        """
+        Adds n_rows constraints lower <= A x <= upper. A is given in coordinate form with rows numbered
+        from zero. Returns indices of the new rows within the model.
+        """
+        row_ids = np.arange(self.n_rows, self.n_rows + n_rows)
+        self.n_rows += n_rows
+        rows = np.asarray(rows)
+        self._rows.append(row_ids[rows])
+        self._cols.append(np.broadcast_to(cols, rows.shape))
+        self._coeffs.append(np.broadcast_to(np.asarray(coeffs, dtype=np.float64), rows.shape))
+        self._row_lower = np.concatenate([self._row_lower, np.broadcast_to(lower, (n_rows,))])
+        self._row_upper = np.concatenate([self._row_upper, np.broadcast_to(upper, (n_rows,))])
+        return row_ids
 
-    def _add_to_energy_balance(self, hour, energy):
+    def _add_series_constraints(self, terms, lower=-np.inf, upper=np.inf):
         """
-        Updates energy balance for a given hour. All hourly balances are constraint to sum to zero.
+        Adds one constraint per hour: lower[hour] <= sum(coeff * series[hour - lag]) <= upper[hour]
+        over (series, coeff, lag) terms. Terms that would reach before the first hour are dropped.
         """
-        self.energy_balance[hour] = self.energy_balance[hour] + energy   
-        print(hour, self.energy_balance[hour])
+        rows, cols, coeffs = [], [], []
+        for series, coeff, lag in terms:
+            hours = np.arange(lag, self.n_hours)
+            rows.append(hours)
+            cols.append(series[hours - lag])
+            coeffs.append(np.broadcast_to(np.asarray(coeff, dtype=np.float64), (self.n_hours,))[hours])
+        return self._add_constraints(self.n_hours, np.concatenate(rows), np.concatenate(cols), np.concatenate(coeffs), lower, upper)
 
     def _new_time_series(self, device_name: str, var_name: str, lowBound=None, upBound=None, binary=False):
         """
-        Create a new time series.
+        Create a new time series. Bounds may be scalars or time series. Returns column indices of the series.
         """
         if binary:
             assert lowBound == None
             assert upBound == None
-            var = pulp.LpVariable.dicts(device_name + "_" + var_name, self.hours, lowBound=0, upBound=1, cat='Integer')
-        else:
-            var = pulp.LpVariable.dicts(device_name + "_" + var_name, self.hours, lowBound=lowBound, upBound=upBound)
+            lowBound, upBound = 0, 1
+        cols = np.arange(self.n_vars, self.n_vars + self.n_hours)
+        self.n_vars += self.n_hours
+        self._lower_bounds = np.concatenate([self._lower_bounds, self._get_hourly_series(-np.inf if lowBound is None else lowBound)])
+        self._upper_bounds = np.concatenate([self._upper_bounds, self._get_hourly_series(np.inf if upBound is None else upBound)])
+        self._integrality = np.concatenate([self._integrality, np.full(self.n_hours, 1 if binary else 0, dtype=np.uint8)])
+        self._cost = np.concatenate([self._cost, np.zeros(self.n_hours)])
 
         if not device_name in self.vars:
             self.vars[device_name] = {}
+            self._columns[device_name] = {}
         device_vars = self.vars[device_name]
         assert not var_name in device_vars
-        device_vars[var_name] = var
-        return var
+        device_vars[var_name] = _PulpSeries(self, cols) if self.backend == 'pulp' else cols
+        self._columns[device_name][var_name] = cols
+        self._series.append((device_name, var_name))
+        return cols
+
+    def _constraint_matrix(self):
+        """
+        Returns the constraint matrix in CSR form as (indptr, indices, data) with duplicate entries summed.
+        The matrix is cached until new devices are added.
+        """
+        if self._matrix is None or self._matrix_blocks != len(self._rows):
+            self._matrix = self._build_constraint_matrix()
+            self._matrix_blocks = len(self._rows)
+        return self._matrix
+
+    def _build_constraint_matrix(self):
+        rows = np.concatenate(self._rows) if self._rows else np.zeros(0, dtype=np.int64)
+        cols = np.concatenate(self._cols) if self._cols else np.zeros(0, dtype=np.int64)
+        coeffs = np.concatenate(self._coeffs) if self._coeffs else np.zeros(0)
+        keys, inverse = np.unique(rows * self.n_vars + cols, return_inverse=True)
+        data = np.bincount(inverse, weights=coeffs, minlength=len(keys))
+        nonzero = data != 0
+        keys, data = keys[nonzero], data[nonzero]
+        indptr = np.searchsorted(keys // max(self.n_vars, 1), np.arange(self.n_rows + 1))
+        return indptr, keys % max(self.n_vars, 1), data
 
-    def solve(self):
+    def solve(self, warm_start=False, verbose=False, solver=None):
         """
         Solves the system of equations. A solution may or may not exist.
-        Must be called after all devices are added.
+        Must be called after all devices are added. The model may be solved again after its data is changed
+        with update_initial_soc, update_prices or update_forecast; only the changed coefficients are updated.
+        Solver status, model size and timings are available in self.stats afterwards.
+        Args:
+          warm_start: start the solver from the previous solution (pulp backend, solvers supporting warm starts).
+          verbose: let the solver write its log to stdout.
+          solver: SolverConfig, or just a solver name; see SolverConfig.
+        Returns a SolveResult.
+        """
+        if solver is None or isinstance(solver, str):
+            solver = SolverConfig(name=solver)
+        start = time.perf_counter()
+        self._dual_cache = None
+        indptr, _, _ = self._constraint_matrix()
+        self.stats = SolveStats(translate_time=time.perf_counter() - start, backend=self.backend,
+            model_type=self.model_type(), n_vars=self.n_vars, n_integer_vars=int(np.count_nonzero(self._integrality)),
+            n_constraints=self.n_rows, n_nonzeros=int(indptr[-1]), build_time=dict(self._build_times))
+        if self.backend == 'pulp':
+            has_solution = self._solve_pulp(warm_start, verbose, solver)
+        else:
+            has_solution = self._solve_scipy(verbose, solver)
+        used_fallback = False
+        if has_solution:
+            self._last_feasible_solution = self._solution
+        elif solver.fallback_to_last_plan and self._last_feasible_solution is not None \
+                and len(self._last_feasible_solution) == self.n_vars:
+            # Plans of a model that had other devices do not fit the current columns and are never restored.
+            logger.warning("No feasible plan found (%s), keeping the last feasible plan", self.stats.status)
+            self._solution = self._last_feasible_solution
+            used_fallback = True
+        logger.info("Solved %s model with %d variables (%d integer), %d constraints, %d non-zeros: %s in %.4f s (translation %.4f s)",
+            self.stats.model_type, self.stats.n_vars, self.stats.n_integer_vars, self.stats.n_constraints,
+            self.stats.n_nonzeros, self.stats.status, self.stats.solve_time, self.stats.translate_time)
+        if self.stats.status != 'Optimal':
+            logger.warning("Solver finished with status %s", self.stats.status)
+        objective = self.get_total_cost() if has_solution or used_fallback else np.nan
+        return SolveResult(status=self.stats.status, objective=objective, solve_time=self.stats.solve_time,
+            has_solution=has_solution, used_fallback=used_fallback)
+
+    def _solve_pulp(self, warm_start, verbose, config):
+        import pulp
+        start = time.perf_counter()
+        if self._pulp_constraints is None or self._pulp_blocks != len(self._rows) or len(self._pulp_vars) != self.n_vars:
+            self._build_pulp_constraints()
+        else:
+            # Structure is unchanged, only right hand sides may have moved.
+            for row, constraint, sense in self._pulp_constraints:
+                rhs = self._row_upper[row] if sense == pulp.LpConstraintLE else self._row_lower[row]
+                constraint.constant = -float(rhs)
+        variables = self._pulp_vars
+        for var, lb, ub in zip(variables, self._lower_bounds.tolist(), self._upper_bounds.tolist()):
+            var.lowBound = None if lb == -np.inf else lb
+            var.upBound = None if ub == np.inf else ub
+        cost_cols = np.flatnonzero(self._cost).tolist()
+        self.problem.setObjective(pulp.LpAffineExpression([(variables[col], self._cost[col]) for col in cost_cols], constant=self._cost_offset))
+        warm_start = warm_start and self._solution is not None and len(self._solution) == self.n_vars
+        if warm_start:
+            # Previous plan, clipped into the updated bounds.
+            initial = np.clip(self._solution, self._lower_bounds, self._upper_bounds)
+            for var, value in zip(variables, initial.tolist()):
+                if not np.isnan(value):
+                    var.setInitialValue(value)
+        self.stats.translate_time += time.perf_counter() - start
+        start = time.perf_counter()
+        solver = _pulp_solver(config, verbose, warm_start)
+        self.stats.solver = solver.name
+        status = self.problem.solve(solver)
+        self.stats.solve_time = time.perf_counter() - start
+        self.stats.status = pulp.LpStatus[status]
+        has_solution = self.problem.sol_status in (pulp.LpSolutionOptimal, pulp.LpSolutionIntegerFeasible)
+        self._solution = np.array([np.nan if var.varValue is None or not has_solution else var.varValue for var in variables])
+        return has_solution
+
+    def _pulp_variables(self):
+        """
+        Returns the pulp variable of every column, creating those of series added since the last call.
+        """
+        import pulp
+        for device_name, var_name in self._series[len(self._pulp_vars) // self.n_hours:]:
+            cat = 'Integer' if self._integrality[self._columns[device_name][var_name][0]] else 'Continuous'
+            self._pulp_vars.extend(pulp.LpVariable(device_name + "_" + var_name + "_" + str(hour), cat=cat) for hour in self.hours)
+        return self._pulp_vars
+
+    def _build_pulp_constraints(self):
+        """
+        Translates constraint rows into pulp constraints of a new problem. Each constraint is remembered together
+        with its row so that right hand sides can be updated in place for the next solve.
         """
-        for hour in self.hours:
-            self.problem += self.energy_balance[hour] == 0
-        self.problem += self.total_cost    
-        status = self.problem.solve()
+        import pulp
+        variables = self._pulp_variables()
+        self.problem = pulp.LpProblem("Power_Optimization", pulp.LpMinimize)
+        self._pulp_constraints = []
+        self._pulp_blocks = len(self._rows)
+        indptr, indices, data = self._constraint_matrix()
+        indices, data = indices.tolist(), data.tolist()
+        for row, (lower, upper) in enumerate(zip(self._row_lower.tolist(), self._row_upper.tolist())):
+            start, end = indptr[row], indptr[row + 1]
+            if start == end:
+                continue
+            expr = pulp.LpAffineExpression([(variables[col], coeff) for col, coeff in zip(indices[start:end], data[start:end])])
+            if lower == upper:
+                senses = [(pulp.LpConstraintEQ, lower)]
+            else:
+                senses = []
+                if lower > -np.inf:
+                    senses.append((pulp.LpConstraintGE, lower))
+                if upper < np.inf:
+                    senses.append((pulp.LpConstraintLE, upper))
+            for sense, rhs in senses:
+                constraint = pulp.LpConstraint(expr, sense, rhs=rhs)
+                self.problem += constraint
+                self._pulp_constraints.append((row, constraint, sense))
+
+    def _solve_scipy(self, verbose, config):
+        start = time.perf_counter()
+        model = self.get_matrix_model()
+        self.stats.translate_time += time.perf_counter() - start
+        solution, stats = solve_matrix_model(model, config, verbose)
+        self.stats.translate_time += stats.translate_time
+        self.stats.solve_time = stats.solve_time
+        self.stats.status = stats.status
+        self.stats.solver = stats.solver
+        self._solution = solution if solution is not None else np.full(self.n_vars, np.nan)
+        return solution is not None
+
+    def get_matrix_model(self):
+        """
+        Returns a copy of the model in matrix form as a MatrixModel, with the current data. Together with
+        get_columns and set_solution it lets the model be solved as a part of a larger one.
+        """
+        indptr, indices, data = self._constraint_matrix()
+        return MatrixModel(cost=self._cost.copy(), cost_offset=self._cost_offset, lower=self._lower_bounds.copy(),
+            upper=self._upper_bounds.copy(), integrality=self._integrality.copy(),
+            rows=np.repeat(np.arange(self.n_rows), np.diff(indptr)), cols=indices.copy(), coeffs=data.copy(),
+            row_lower=self._row_lower.copy(), row_upper=self._row_upper.copy())
+
+    def get_columns(self):
+        """
+        Returns a nested dictionary device -> variable -> column indices of every time series in get_matrix_model().
+        """
+        return {device_name: dict(device_columns) for device_name, device_columns in self._columns.items()}
+
+    def set_solution(self, solution):
+        """
+        Sets the plan from a solution vector with one value per column of get_matrix_model(), e.g. the part of the
+        solution of a larger model that belongs to this one. The plan is then available from get_time_series and
+        the other getters.
+        """
+        solution = np.asarray(solution, dtype=np.float64)
+        assert solution.shape == (self.n_vars,)
+        self._solution = solution
+        self._dual_cache = None
+
+    def _solution_matrix(self, dtype=np.float32):
+        """
+        Returns the solution as a (time series, hour) array. Time series occupy consecutive columns,
+        so this is a reshape of the solution vector.
+        """
+        return self._solution.reshape(len(self._series), self.n_hours).astype(dtype)
 
     def get_time_series(self):
         """
         Returns a nested dictionary containing all time series as np ndarray.
         """
         res = {}
-        for device_name in self.vars:
-            device_vars = self.vars[device_name]
-            device_series = {}
-            for var_name in device_vars:
-                var = device_vars[var_name]
-                device_series[var_name] = np.array([var[hour].varValue for hour in self.hours], dtype=np.float32)
-            res[device_name] = device_series
+        for values, (device_name, var_name) in zip(self._solution_matrix(), self._series):
+            res.setdefault(device_name, {})[var_name] = values
+        self._check_battery_overlap(res)
+        return res
+
+    def _check_battery_overlap(self, series, atol=1e-6):
+        """
+        Warns about hours in which a battery is planned to charge and discharge at the same time.
+        Returns a dict battery name -> hours with overlap, for batteries that have any.
+        """
+        overlaps = {}
+        for name, device in self._devices.items():
+            if device['kind'] != 'battery':
+                continue
+            hours = np.flatnonzero((series[name]['charge_rate'] > atol) & (series[name]['discharge_rate'] < -atol))
+            if len(hours) > 0:
+                logger.warning("Battery %s charges and discharges at the same time in hours %s", name, hours.tolist())
+                overlaps[name] = hours
+        return overlaps
+
+    def get_solution_array(self, dtype=np.float32):
+        """
+        Returns all time series as one contiguous structured array with a record per hour, filled from the
+        solution vector in one go. Fields are nested as in get_time_series: array['battery']['soc'].
+        """
+        itemsize = np.dtype(dtype).itemsize
+        devices = {}
+        for index, (device_name, var_name) in enumerate(self._series):
+            devices.setdefault(device_name, []).append((var_name, index))
+        names, formats, offsets = [], [], []
+        for device_name, device_vars in devices.items():
+            first = device_vars[0][1]
+            last = device_vars[-1][1]
+            names.append(device_name)
+            formats.append(np.dtype({'names': [var_name for var_name, _ in device_vars], 'formats': [dtype] * len(device_vars),
+                'offsets': [(index - first) * itemsize for _, index in device_vars], 'itemsize': (last - first + 1) * itemsize}))
+            offsets.append(first * itemsize)
+        record = np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': len(self._series) * itemsize})
+        values = np.ascontiguousarray(self._solution_matrix(dtype).T)
+        return values.view(record).reshape(self.n_hours)
+
+    def get_dataframe(self, hour_titles=None):
+        """
+        Returns all time series as a pandas DataFrame with (device, variable) columns, indexed by hour_titles
+        (e.g. hours of the Nordpool price list) or by hour number. Requires pandas.
+        """
+        import pandas as pd
+        columns = pd.MultiIndex.from_tuples(self._series, names=['device', 'variable'])
+        index = pd.Index(self.hours if hour_titles is None else hour_titles, name='hour')
+        assert len(index) == self.n_hours
+        return pd.DataFrame(self._solution_matrix(np.float64).T, index=index, columns=columns)
+
+    def get_hourly_costs(self):
+        """
+        Returns cost attributed to every hour as a dict device -> np ndarray of costs per hour, e.g. the import
+        cost of a mains supply or the cycle cost of a battery. The remaining value of energy after the last hour
+        is attributed to the last hour. Constant cost terms that do not depend on the plan are not included.
+        """
+        costs = (self._cost * self._solution).reshape(len(self._series), self.n_hours)
+        res = {}
+        for values, (device_name, _) in zip(costs, self._series):
+            res[device_name] = res[device_name] + values if device_name in res else values
         return res
 
+    def update_initial_soc(self, name, initial_soc):
+        """
+        Sets a new initial state of charge of a battery for the next solve.
+        """
+        device = self._devices[name]
+        assert device['kind'] == 'battery'
+        row = device['charge_rows'][0]
+        self._row_lower[row] = device['initial_retention'] * initial_soc
+        self._row_upper[row] = device['initial_retention'] * initial_soc
+        device['definition']['initial_soc'] = initial_soc
+
+    def update_prices(self, name, import_hourly_prices=None, export_hourly_prices=None):
+        """
+        Sets new import and/or export prices of a mains electricity supply for the next solve.
+        Prices for which a pure LP model is no longer correct add the binary series to it (see force_direction
+        and force_exclusive of add_battery).
+        """
+        device = self._devices[name]
+        assert device['kind'] == 'mains'
+        import_cost = self._cost[device['import']]
+        if not import_hourly_prices is None:
+            import_cost = self._get_hourly_series(import_hourly_prices) * self.step_hours
+        export_cost = self._cost[device['export']]
+        if not export_hourly_prices is None:
+            assert device['max_export_power'] > 0
+            export_cost = self._get_hourly_series(export_hourly_prices) * self.step_hours
+        self._cost[device['import']] = import_cost
+        self._cost[device['export']] = export_cost
+        # Prices that make simultaneous import and export or burning energy in batteries optimal
+        # add the binary series to the model, as add_mains_electricity_supply and add_battery would.
+        if device['mode'] == 'LP' and device['max_export_power'] > 0 and not np.all(export_cost < import_cost):
+            self._add_direction_series(name)
+        self._update_battery_modes()
+        if not import_hourly_prices is None:
+            device['definition']['import_hourly_prices'] = import_hourly_prices
+        if not export_hourly_prices is None:
+            device['definition']['export_hourly_prices'] = export_hourly_prices
+
+    def update_forecast(self, name, forecast):
+        """
+        Sets a new forecast for the next solve: hourly_consumption of a fixed consumption,
+        estimated_hourly_production of a solar plant, min_cumulative_consuption of a flexible consumption
+        or hourly_demand of a heating consumption.
+        """
+        device = self._devices[name]
+        forecast = self._get_hourly_series(forecast)
+        assert np.all(forecast >= 0)
+        if device['kind'] == 'fixed_consumption':
+            self._lower_bounds[device['consumption']] = forecast
+            self._upper_bounds[device['consumption']] = forecast
+            device['definition']['hourly_consumption'] = forecast
+        elif device['kind'] == 'solar':
+            self._upper_bounds[device['production']] = forecast
+            device['definition']['estimated_hourly_production'] = forecast
+        elif device['kind'] == 'flexible_consumption':
+            self._lower_bounds[device['cumul_consumption']] = forecast
+            device['definition']['min_cumulative_consuption'] = forecast
+        elif device['kind'] == 'heating':
+            cumul_demand = np.cumsum(forecast * self.step_hours)
+            self._lower_bounds[device['cumul_consumption']] = cumul_demand + device['tol_cumul_min']
+            self._upper_bounds[device['cumul_consumption']] = cumul_demand + device['tol_cumul_max']
+            final_demand_cost = cumul_demand[-1] * device['final_energy_value_per_kwh']
+            self._cost_offset += final_demand_cost - device['final_demand_cost']
+            device['final_demand_cost'] = final_demand_cost
+            device['definition']['hourly_demand'] = forecast
+        else:
+            raise ValueError("Device %s has no forecast" % name)
+
+    def _duals(self):
+        """
+        Solves the LP relaxation of the model with integer series fixed at their planned values and returns the
+        marginal cost of the lower and upper bound of every row and column as (row_lower, row_upper, lower, upper).
+        For rows with equal bounds the whole dual is in row_lower. Cached until the next solve.
+        """
+        if self._dual_cache is not None:
+            return self._dual_cache
+        from scipy.optimize import linprog
+        from scipy.sparse import csr_array, vstack
+        assert self._solution is not None and not np.any(np.isnan(self._solution)), "Solve the model first"
+        indptr, indices, data = self._constraint_matrix()
+        matrix = csr_array((data, indices, indptr), shape=(self.n_rows, self.n_vars))
+        lower, upper = self._lower_bounds.copy(), self._upper_bounds.copy()
+        integer = self._integrality > 0
+        lower[integer] = upper[integer] = np.round(self._solution[integer])
+        equal = self._row_lower == self._row_upper
+        has_upper = ~equal & (self._row_upper < np.inf)
+        has_lower = ~equal & (self._row_lower > -np.inf)
+        # linprog takes A_ub x <= b_ub, so lower bounded rows enter negated.
+        inequalities = vstack([matrix[np.flatnonzero(has_upper)], -matrix[np.flatnonzero(has_lower)]], format='csr')
+        res = linprog(self._cost, A_ub=inequalities, b_ub=np.concatenate([self._row_upper[has_upper], -self._row_lower[has_lower]]),
+            A_eq=matrix[np.flatnonzero(equal)], b_eq=self._row_lower[equal], bounds=np.column_stack([lower, upper]), method='highs')
+        if res.status != 0:
+            raise ValueError("LP relaxation with fixed integers could not be solved: %s" % res.message)
+        row_lower = np.zeros(self.n_rows)
+        row_upper = np.zeros(self.n_rows)
+        row_lower[equal] = res.eqlin.marginals
+        n_upper = np.count_nonzero(has_upper)
+        row_upper[has_upper] = res.ineqlin.marginals[:n_upper]
+        row_lower[has_lower] = -res.ineqlin.marginals[n_upper:]
+        self._dual_cache = (row_lower, row_upper, res.lower.marginals, res.upper.marginals)
+        return self._dual_cache
+
+    def get_sensitivity(self):
+        """
+        Returns a Sensitivity report of the solved plan: marginal value of energy in every hour, duals of the soc bounds
+        of batteries, value of battery capacity and reduced costs of all series. Duals come from one LP solve
+        (scipy.optimize.linprog, HiGHS) of the model with integer series fixed at their planned values.
+        """
+        row_lower, row_upper, lower, upper = self._duals()
+        reduced_costs = {}
+        for values, (device_name, var_name) in zip((lower + upper).reshape(len(self._series), self.n_hours), self._series):
+            reduced_costs.setdefault(device_name, {})[var_name] = values
+        soc_lower, soc_upper, capacity_value = {}, {}, {}
+        for name, device in self._devices.items():
+            if device['kind'] != 'battery':
+                continue
+            soc = self._columns[name]['soc']
+            soc_lower[name] = lower[soc]
+            soc_upper[name] = upper[soc]
+            capacity_value[name] = -float(upper[soc][~device['max_soc_hours']].sum())
+        return Sensitivity(energy_value=row_lower[:self.n_hours] / self.step_hours, soc_lower=soc_lower, soc_upper=soc_upper,
+            capacity_value=capacity_value, reduced_costs=reduced_costs)
+
+    def what_if(self, changes):
+        """
+        Prices small input changes without solving again, to first order around the solved plan.
+        Args:
+          changes: dict (device name, argument) -> changes of the add_* argument, an array of shape (k, n_hours)
+            for hourly arguments or (k,) for scalar ones, one row per case. Supported arguments:
+            import_hourly_prices and export_hourly_prices of a supply, hourly_consumption,
+            estimated_hourly_production, min_cumulative_consuption and hourly_demand forecasts, and
+            initial_soc, capacity, min_soc and max_soc of a battery.
+            E.g. {('mains', 'import_hourly_prices'): delta} with delta[case, 18] = 1 prices a one unit change at 18:00.
+        Returns an np.ndarray of k estimated changes of the total cost. Estimates are exact while the same
+        constraints stay binding; price changes are exact as long as the plan stays optimal. Every soc bound is
+        priced through the input setting it: capacity or max_soc (max_soc where they are equal), zero or min_soc.
+        """
+        row_lower, row_upper, lower, upper = self._duals()
+        total = None
+        for (name, argument), delta in changes.items():
+            device = self._devices[name]
+            delta = np.asarray(delta, dtype=np.float64)
+            kind = device['kind']
+            if kind == 'mains' and argument in ('import_hourly_prices', 'export_hourly_prices'):
+                cols = device['import' if argument == 'import_hourly_prices' else 'export']
+                change = delta @ (self._solution[cols] * self.step_hours)
+            elif kind == 'fixed_consumption' and argument == 'hourly_consumption':
+                change = delta @ (lower + upper)[device['consumption']]
+            elif kind == 'solar' and argument == 'estimated_hourly_production':
+                change = delta @ upper[device['production']]
+            elif kind == 'flexible_consumption' and argument == 'min_cumulative_consuption':
+                change = delta @ lower[device['cumul_consumption']]
+            elif kind == 'heating' and argument == 'hourly_demand':
+                cumul_delta = np.cumsum(delta * self.step_hours, axis=-1)
+                cols = device['cumul_consumption']
+                change = cumul_delta @ (lower + upper)[cols] + cumul_delta[..., -1] * device['final_energy_value_per_kwh']
+            elif kind == 'battery' and argument == 'initial_soc':
+                change = delta * device['initial_retention'] * row_lower[device['charge_rows'][0]]
+            elif kind == 'battery' and argument in ('capacity', 'min_soc', 'max_soc'):
+                soc = self._columns[name]['soc']
+                if argument == 'min_soc':
+                    change = delta @ np.where(device['min_soc_hours'], lower[soc], 0.0)
+                elif argument == 'max_soc':
+                    change = delta @ np.where(device['max_soc_hours'], upper[soc], 0.0)
+                else:
+                    change = delta * upper[soc][~device['max_soc_hours']].sum()
+            else:
+                raise ValueError("what_if does not support argument %s of device %s" % (argument, name))
+            total = change if total is None else total + change
+        return total
+
+    def model_type(self):
+        """
+        Returns 'MILP' if the model contains integer variables and 'LP' otherwise.
+        """
+        return 'MILP' if np.any(self._integrality) else 'LP'
+
+    def get_total_cost(self):
+        """
+        Returns total cost of the solved plan, i.e. the minimized objective.
+        """
+        return float(self._cost @ self._solution + self._cost_offset)
+
     def print_time_series(self, ts=None, prefix=''):
         if ts is None:
             ts = self.get_time_series()
@@ -83,7 +874,9 @@ class EnergyOptimizer():
             else:
                 print(prefix + key + ':', value)
 
-    def add_mains_electricity_supply(self, name, max_import_power, import_hourly_prices, max_export_power=0, export_hourly_prices=None):
+    @_timed_device
+    def add_mains_electricity_supply(self, name, max_import_power, import_hourly_prices, max_export_power=0, export_hourly_prices=None,
+            force_direction=False):
         """
         Add mains electricy supply the system. Optimizer can work with several different
         electricity supplies (for instance, mains supply and a diesel generator with estimated running costs as hourly_prices)
@@ -91,50 +884,75 @@ class EnergyOptimizer():
           max_power: max power provided by the mains supply.
           hourly_prices: hourly electricity prices
           max_export_power: maximum export power provided by the mains supply
-          export_hourly_prices: either known export prices (if net billing is used) or estimated value of electricity credits 
-            if net metering is used; the later would most likely be waverage winter electricity tariffs after subtracting any 
+          export_hourly_prices: either known export prices (if net billing is used) or estimated value of electricity credits
+            if net metering is used; the later would most likely be waverage winter electricity tariffs after subtracting any
             'grid storage' fees.
+          force_direction: always model import/export exclusivity with a binary direction series.
+            By default the binary series is only added when simultaneous import and export could be optimal,
+            i.e. when export is possible and the export price is not strictly below the import price in some hour,
+            also after such prices are set with update_prices. Otherwise the supply is modelled as a pure LP.
+            Chosen mode is recorded in supply_modes.
         """
         assert max_import_power >= 0
         assert max_export_power >= 0
         assert len(import_hourly_prices) == self.n_hours
-        # dfirection: 0 for exports, 1 for imports.
-        direction = self._new_time_series(name, "direction", binary=True)
+        import_hourly_prices = np.asarray(import_hourly_prices, dtype=np.float64)
+        if max_export_power > 0:
+            assert len(export_hourly_prices) == self.n_hours
+            export_hourly_prices = np.asarray(export_hourly_prices, dtype=np.float64)
+        needs_direction = max_export_power > 0 and not np.all(export_hourly_prices < import_hourly_prices)
+        mode = 'MILP' if force_direction or needs_direction else 'LP'
         electricity_import = self._new_time_series(name, "import", lowBound=0, upBound=max_import_power)
         electricity_export = self._new_time_series(name, "export", lowBound=-max_export_power, upBound=0)
-        electricity_import_cost = pulp.lpSum(electricity_import[hour] * import_hourly_prices[hour] for hour in self.hours)
-        self._add_cost(electricity_import_cost)
+        self._add_cost(electricity_import, import_hourly_prices * self.step_hours)
         if max_export_power > 0:
-            assert len(export_hourly_prices) == self.n_hours
-            electricity_export_cost = pulp.lpSum(electricity_export[hour] * export_hourly_prices[hour] for hour in self.hours)
             # the later cost is negative, so it is actually a profit.
-            self._add_cost(electricity_export_cost)
-        for hour in self.hours:
-            self._add_to_energy_balance(hour, electricity_import[hour] + electricity_export[hour])
-            # Make sure that we either import or export, but do not do both at the same time.
-            self.problem += electricity_import[hour] <= max_import_power * direction[hour]
-            self.problem += electricity_export[hour] >= -max_export_power * (1 - direction[hour])
-        
-        return electricity_import
-
-    def _get_hourly(self, x, hour):
-        if isinstance(x, int):
-            return x
-        if isinstance(x, float):
-            return x
-        assert len(x) == self.n_hours    
-        return x[hour]    
+            self._add_cost(electricity_export, export_hourly_prices * self.step_hours)
+        self._add_to_energy_balance(electricity_import, 1.0)
+        self._add_to_energy_balance(electricity_export, 1.0)
+        self._devices[name] = {'kind': 'mains', 'import': electricity_import, 'export': electricity_export,
+            'max_import_power': max_import_power, 'max_export_power': max_export_power, 'mode': 'LP'}
+        # In LP mode importing and exporting the same energy in one hour strictly increases the cost,
+        # so the solver never does both at the same time.
+        self.supply_modes[name] = 'LP'
+        if mode == 'MILP':
+            self._add_direction_series(name)
+        # Batteries added before may now burn energy (see add_battery).
+        self._update_battery_modes()
+
+        return self.vars[name]["import"]
 
+    def _add_direction_series(self, name):
+        """
+        Forbids simultaneous import and export of a supply with a binary direction series.
+        """
+        device = self._devices[name]
+        # dfirection: 0 for exports, 1 for imports.
+        direction = self._new_time_series(name, "direction", binary=True)
+        # Make sure that we either import or export, but do not do both at the same time.
+        self._add_series_constraints([(device['import'], 1.0, 0), (direction, -device['max_import_power'], 0)], upper=0.0)
+        self._add_series_constraints([(device['export'], 1.0, 0), (direction, -device['max_export_power'], 0)],
+            lower=-device['max_export_power'])
+        device['mode'] = self.supply_modes[name] = 'MILP'
+
+    def _get_hourly_series(self, x):
+        if np.ndim(x) == 0:
+            return np.full(self.n_hours, x, dtype=np.float64)
+        assert len(x) == self.n_hours
+        return np.asarray(x, dtype=np.float64)
+
+    @_timed_device
     def add_battery(self, name, capacity, initial_soc, efficiency,
             max_charge_power, max_discharge_power, cost_of_cycle_kwh,
-            final_energy_value_per_kwh, min_soc=None, max_soc=None):  
+            final_energy_value_per_kwh, min_soc=None, max_soc=None, charge_efficiency=None, discharge_efficiency=None,
+            standby_loss=0.0, aux_power=0.0, force_exclusive=False):
         """
         Add battery into the system. Assumied minimal state of charge is 0 - if one wants to maintain some other
         minimal state of charge one has to model a smaller battery and shift all SOC values by the desired amount.
         Args:
           capacity: battery capacity in kwh
           initial_soc: initial state of charge (scalar)
-          efficiency: round trip efficiency
+          efficiency: round trip efficiency; may be None if both charge_efficiency and discharge_efficiency are given
           max_charge_power: maximum cgarging power
           max_discharge_power: maximum discharge power
           cost_of_cycle_kwh: estimated battery round trip amortization cost.
@@ -142,84 +960,167 @@ class EnergyOptimizer():
             without it the controller would fully discharge the battery.
           min_soc: minimum final soc at the end each hour (scalar or time series)
           max_soc: maximum final soc at the end of each hour (scalar or time series)
-        """  
+          charge_efficiency: share of charge_rate (drawn from the energy balance) that gets stored.
+          discharge_efficiency: share of discharge_rate (taken from the battery) that reaches the energy balance.
+            If neither is given, all losses are applied on discharge (charge_efficiency=1, discharge_efficiency=efficiency);
+            if only one is given, the other one is efficiency divided by it.
+          standby_loss: share of the stored energy lost per hour (self-discharge).
+          aux_power: constant power drawn by the battery system (BMS, inverter standby) in kW.
+          force_exclusive: always forbid simultaneous charging and discharging with a binary charging series.
+            By default the binary series is only added when burning energy may pay, i.e. when a supply has a
+            non-positive import price or a negative export price in some hour, also when the supply is added or its
+            prices are updated later. Otherwise
+            charge_rate / max_charge_power - discharge_rate / max_discharge_power <= 1 is added instead, which needs
+            no integer variables; with the conversion losses and cycle cost simultaneous charging and discharging is
+            then more expensive than either alone. get_time_series warns about any remaining overlap.
+            Chosen mode is recorded in battery_modes.
+        """
         assert max_charge_power > 0
         assert max_discharge_power > 0
+        assert 0 <= standby_loss < 1
+        assert aux_power >= 0
+        if charge_efficiency is None and discharge_efficiency is None:
+            charge_efficiency, discharge_efficiency = 1.0, efficiency
+        elif discharge_efficiency is None:
+            discharge_efficiency = efficiency / charge_efficiency
+        elif charge_efficiency is None:
+            charge_efficiency = efficiency / discharge_efficiency
+        elif not efficiency is None:
+            assert np.isclose(efficiency, charge_efficiency * discharge_efficiency)
+        assert 0 < charge_efficiency <= 1
+        assert 0 < discharge_efficiency <= 1
+        soc_lower = np.zeros(self.n_hours)
+        soc_upper = self._get_hourly_series(capacity)
+        # Hours in which min_soc and max_soc rather than zero and capacity set the soc bounds (see what_if).
+        min_soc_hours = np.zeros(self.n_hours, dtype=bool)
+        max_soc_hours = np.zeros(self.n_hours, dtype=bool)
+        if not min_soc is None:
+            min_soc_hours = self._get_hourly_series(min_soc) >= soc_lower
+            soc_lower = np.maximum(soc_lower, self._get_hourly_series(min_soc))
+        if not max_soc is None:
+            # Where max_soc equals capacity a larger capacity does not move the bound.
+            max_soc_hours = self._get_hourly_series(max_soc) <= soc_upper
+            soc_upper = np.minimum(soc_upper, self._get_hourly_series(max_soc))
+        if not min_soc is None and not max_soc is None:
+            assert np.all(self._get_hourly_series(min_soc) <= self._get_hourly_series(max_soc))
         charge_rate = self._new_time_series(name, "charge_rate", lowBound = 0, upBound= max_charge_power)
         discharge_rate = self._new_time_series(name, "discharge_rate", lowBound = -max_discharge_power, upBound=0)
-        soc = self._new_time_series(name, "soc", lowBound=0, upBound=capacity)
-        current_soc = initial_soc
-        for hour in self.hours:
-            self._add_to_energy_balance(hour, -charge_rate[hour] - discharge_rate[hour] * efficiency)
-            self.problem += soc[hour] == current_soc + charge_rate[hour] + discharge_rate[hour] # Conservation of charge 
-            current_soc = soc[hour]
-            s0, s1 = None, None
-            if not min_soc is None:
-                s0 = self._get_hourly(min_soc, hour)
-                self.problem += current_soc >= s0
-            if not max_soc is None:
-                s1 = self._get_hourly(max_soc, hour)
-                self.problem += current_soc <= s1
-            if not s0 is None and not s1 is None:
-                assert s0 <= s1    
-        amortization_cost = pulp.lpSum(charge_rate[hour] * cost_of_cycle_kwh for hour in self.hours)    
-        remaining_value = current_soc * efficiency * final_energy_value_per_kwh
-        self._add_cost(amortization_cost - remaining_value)
-        return soc, charge_rate, discharge_rate
-
-    def add_fixed_consumption(self, name, hourly_consumption):  
+        soc = self._new_time_series(name, "soc", lowBound=soc_lower, upBound=soc_upper)
+        self._add_to_energy_balance(charge_rate, -1.0)
+        self._add_to_energy_balance(discharge_rate, -discharge_efficiency)
+        # Constant consumption of the battery system, moved to the right hand side of the energy balance.
+        self._row_lower[:self.n_hours] += aux_power
+        self._row_upper[:self.n_hours] += aux_power
+        # Conservation of charge: soc[hour] - retention[hour] * soc[hour - 1]
+        #   - (charge_efficiency * charge_rate[hour] + discharge_rate[hour]) * step_hours[hour] == 0
+        retention = 1 - standby_loss * self.step_hours
+        assert np.all(retention > 0)
+        initial = np.zeros(self.n_hours)
+        initial[0] = retention[0] * initial_soc
+        charge_rows = self._add_series_constraints([(soc, 1.0, 0), (soc, -retention, 1),
+            (charge_rate, -charge_efficiency * self.step_hours, 0), (discharge_rate, -self.step_hours, 0)], lower=initial, upper=initial)
+        self._devices[name] = {'kind': 'battery', 'charge_rows': charge_rows, 'initial_retention': retention[0],
+            'charge_rate': charge_rate, 'discharge_rate': discharge_rate, 'max_charge_power': max_charge_power,
+            'max_discharge_power': max_discharge_power, 'min_soc_hours': min_soc_hours, 'max_soc_hours': max_soc_hours}
+        if force_exclusive or self._burning_energy_may_pay():
+            self._add_charging_series(name)
+        else:
+            self._add_series_constraints([(charge_rate, 1.0 / max_charge_power, 0), (discharge_rate, -1.0 / max_discharge_power, 0)],
+                upper=1.0)
+            self.battery_modes[name] = 'LP'
+        self._add_cost(charge_rate, cost_of_cycle_kwh * self.step_hours)
+        # Remaining value of energy in the battery after the last hour.
+        self._add_cost(soc[-1], -discharge_efficiency * final_energy_value_per_kwh)
+        return self.vars[name]["soc"], self.vars[name]["charge_rate"], self.vars[name]["discharge_rate"]
+
+    def _burning_energy_may_pay(self):
+        """
+        Returns True if a supply has a non-positive import price or a negative export price in some hour,
+        where charging and discharging a battery at the same time may be optimal.
+        """
+        return any(np.any(self._cost[device['import']] <= 0)
+            or (device['max_export_power'] > 0 and np.any(self._cost[device['export']] < 0))
+            for device in self._devices.values() if device['kind'] == 'mains')
+
+    def _update_battery_modes(self):
+        """
+        Adds the charging series to batteries modelled as a pure LP once burning energy may pay.
+        """
+        if self._burning_energy_may_pay():
+            for name, mode in list(self.battery_modes.items()):
+                if mode == 'LP':
+                    self._add_charging_series(name)
+
+    def _add_charging_series(self, name):
+        """
+        Forbids simultaneous charging and discharging of a battery with a binary charging series.
+        """
+        device = self._devices[name]
+        # 1 while charging, 0 while discharging.
+        charging = self._new_time_series(name, "charging", binary=True)
+        self._add_series_constraints([(device['charge_rate'], 1.0, 0), (charging, -device['max_charge_power'], 0)], upper=0.0)
+        self._add_series_constraints([(device['discharge_rate'], 1.0, 0), (charging, -device['max_discharge_power'], 0)],
+            lower=-device['max_discharge_power'])
+        self.battery_modes[name] = 'MILP'
+
+    @_timed_device
+    def add_fixed_consumption(self, name, hourly_consumption):
         """
         Add simple fixed hourly consumption that can not be optimized.
         """
         assert len(hourly_consumption) == self.n_hours
-        consumption = self._new_time_series(name, "consumption", lowBound = 0, upBound= np.amax(hourly_consumption))
-        for hour in self.hours:
-            assert hourly_consumption[hour] >= 0 
-            self._add_to_energy_balance(hour, -consumption[hour])
-            self.problem += consumption[hour] == hourly_consumption[hour]
-        return consumption
+        hourly_consumption = np.asarray(hourly_consumption, dtype=np.float64)
+        assert np.all(hourly_consumption >= 0)
+        consumption = self._new_time_series(name, "consumption", lowBound = hourly_consumption, upBound= hourly_consumption)
+        self._add_to_energy_balance(consumption, -1.0)
+        self._devices[name] = {'kind': 'fixed_consumption', 'consumption': consumption}
+        return self.vars[name]["consumption"]
 
-    def add_solar_production(self, name, estimated_hourly_production):  
+    @_timed_device
+    def add_solar_production(self, name, estimated_hourly_production):
         """
         A solar plant with an extimated_hourly production.
-        Actual production may be lower if the system does not find a way to export or consume available energy. 
+        Actual production may be lower if the system does not find a way to export or consume available energy.
         """
         assert len(estimated_hourly_production) == self.n_hours
-        production = self._new_time_series(name, "production", lowBound = 0, upBound= np.amax(estimated_hourly_production))
-        for hour in self.hours:
-            self.problem += production[hour] >= 0
-            self.problem += production[hour] <= estimated_hourly_production[hour]
-            self._add_to_energy_balance(hour, production[hour])
-        return production
+        production = self._new_time_series(name, "production", lowBound = 0, upBound= estimated_hourly_production)
+        self._add_to_energy_balance(production, 1.0)
+        self._devices[name] = {'kind': 'solar', 'production': production}
+        return self.vars[name]["production"]
 
-    def add_flexible_consumption(self, name, max_power, min_cumulative_consuption):  
+    @_timed_device
+    def add_flexible_consumption(self, name, max_power, min_cumulative_consuption):
         """
         Adds a total cumulative consumption demand when it is not important when exactly it happens as long as it happens by some hour.
         A good usecase is charging electric cars.
         max_power:
           maximum cunsuption power (would be max charging power in case of an EV)
         min_cumulative_consuption:
-          energy consumption (e.g. electric car charging) that has to happen on or before a set hour. For instance, if the only
+          energy consumption in kWh (e.g. electric car charging) that has to happen on or before a set hour. For instance, if the only
           demand is to have a car charged by 10kWh in 5 hours time, one can add min_cumulative_consuption=[0,0,0,0,10] requirement.
           However, one can also demant that half would be charhed in 3 hours time (because of, say, potential emergencies)
           and another half has to be charged in 5 hours time: [0,0,5,0,10]. Depending on pricing and other constraints
           (such as max_power constraint) the algorithm may chose to do this earlier, e.g. may distribute charging as [2,2,1,5,0]
-        """  
+        """
         assert len(min_cumulative_consuption) == self.n_hours
+        min_cumulative_consuption = np.asarray(min_cumulative_consuption, dtype=np.float64)
+        assert np.all(min_cumulative_consuption >= 0)
         consumption = self._new_time_series(name, "consumption", lowBound = 0, upBound=max_power)
-        cumul_consumption = 0.0
-        for hour in self.hours:
-            assert min_cumulative_consuption[hour] >= 0 
-            self._add_to_energy_balance(hour, -consumption[hour])
-            cumul_consumption = cumul_consumption + consumption[hour]
-            self.problem += cumul_consumption >= min_cumulative_consuption[hour]
-        return consumption    
-    
-    def add_heating_consumption(self, name, max_heat_power, hourly_demand, tol_cumul_min, tol_cumul_max, final_energy_value_per_kwh):  
+        # Cumulative consumption at the end of each hour, tracked like the soc of a battery
+        # so that the model grows linearly with the number of hours.
+        cumul_consumption = self._new_time_series(name, "cumul_consumption", lowBound=min_cumulative_consuption)
+        self._add_to_energy_balance(consumption, -1.0)
+        self._add_series_constraints([(cumul_consumption, 1.0, 0), (cumul_consumption, -1.0, 1),
+            (consumption, -self.step_hours, 0)], lower=0.0, upper=0.0)
+        self._devices[name] = {'kind': 'flexible_consumption', 'cumul_consumption': cumul_consumption}
+        return self.vars[name]["consumption"]
+
+    @_timed_device
+    def add_heating_consumption(self, name, max_heat_power, hourly_demand, tol_cumul_min, tol_cumul_max, final_energy_value_per_kwh):
         """
         Models a heat pump consumption that may be throttled up or down within desired bounds.
         We are operating in electricity kWh and not heat kWh (that would be further multipled by COP)
-        hourly_demand must be expressed in electricity kWh
+        hourly_demand must be expressed in electricity kWh (per hour, i.e. average kW over each time step)
         Arguments:
            name: name of the device
            hourly_demeand: estimated hourly heat pump demand at the desired steady state temperature.
@@ -228,28 +1129,31 @@ class EnergyOptimizer():
            tol_cumul_min/max: minimal and maximal deviations of planned cumulative heating power from its target;
               as house temperature change is proportional to the cumulative heating input minus external cooling loss (the later is fixed),
               house temperature tolerance can be expressed in terms of cumulative heating energy toleance which can
-              be estimated from known temperature-gradient vs heating energy table (outside of the scope of this function) 
+              be estimated from known temperature-gradient vs heating energy table (outside of the scope of this function)
               Cumulative power deviations from hourly_demand is proportional to temperature drop or rise inside the house.
               If the house is already too cold/hot,
               the appropriate min/max value should be set to 0. tol_cumul_min <= 0; tol_cumul_max >= 0
               If tolerance is zero on both sides then the system has no space for heating optimizations.
            final_energy_value_per_kwh: estimated electricity price after the last hour with known price; depending on this
-              value the planner may plan to leave the house slighly warmer or cooler.   
-        """  
+              value the planner may plan to leave the house slighly warmer or cooler.
+        """
         assert tol_cumul_min <= 0
         assert tol_cumul_max >= 0
         assert len(hourly_demand) == self.n_hours
+        hourly_demand = np.asarray(hourly_demand, dtype=np.float64)
+        assert np.all(hourly_demand >= 0)
         heating_power = self._new_time_series(name, "consumption", lowBound = 0, upBound=max_heat_power)
-        cumul_demand = 0.0
-        cumul_power= 0.0
-        for hour in self.hours:
-            assert hourly_demand[hour] >= 0 
-            cumul_demand = cumul_demand + hourly_demand[hour]
-            cumul_power = cumul_power + heating_power[hour]
-            self._add_to_energy_balance(hour, -heating_power[hour])
-            self.problem += cumul_power >= cumul_demand + tol_cumul_min
-            self.problem += cumul_power <= cumul_demand + tol_cumul_max
-        # Reward for accumulating heat and penalize for final underheating.    
-        self._add_cost((cumul_demand - cumul_power) * final_energy_value_per_kwh)
-        return heating_power
-
+        cumul_demand = np.cumsum(hourly_demand * self.step_hours)
+        # Cumulative heating power at the end of each hour, kept within tolerance of the cumulative demand.
+        cumul_power = self._new_time_series(name, "cumul_consumption",
+            lowBound=cumul_demand + tol_cumul_min, upBound=cumul_demand + tol_cumul_max)
+        self._add_to_energy_balance(heating_power, -1.0)
+        self._add_series_constraints([(cumul_power, 1.0, 0), (cumul_power, -1.0, 1), (heating_power, -self.step_hours, 0)],
+            lower=0.0, upper=0.0)
+        # Reward for accumulating heat and penalize for final underheating.
+        final_demand_cost = cumul_demand[-1] * final_energy_value_per_kwh
+        self._add_cost(cumul_power[-1], -final_energy_value_per_kwh, constant=final_demand_cost)
+        self._devices[name] = {'kind': 'heating', 'cumul_consumption': cumul_power, 'tol_cumul_min': tol_cumul_min,
+            'tol_cumul_max': tol_cumul_max, 'final_energy_value_per_kwh': final_energy_value_per_kwh,
+            'final_demand_cost': final_demand_cost}
+        return self.vars[name]["consumption"]
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import storage
+from optim import EnergyOptimizer
+
+
+logger = logging.getLogger(__name__)
+
+
+def _quantize(x, quantum):
+    if quantum is None:
+        return x
+    return np.round(np.asarray(x, dtype=np.float64) / quantum) * quantum
+
+
+def _canonical(value):
+    """
+    Converts scalars and series to plain floats and lists, so that equal inputs serialize equally.
+    """
+    if isinstance(value, dict):
+        return {k: _canonical(v) for k, v in value.items()}
+    if np.ndim(value) > 0:
+        return np.asarray(value, dtype=np.float64).tolist()
+    if isinstance(value, (int, float, np.number)) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+
+class PlanCache():
+
+    def __init__(self, max_entries=128, ttl_seconds=None, soc_quantum=None, price_quantum=None, path=None,
+            backend='pulp', solver=None, clock=time.time):
+        """
+        Memoizes plans of EnergyOptimizer. Plans are keyed on a hash of the full device configuration and
+        input series, after rounding initial_soc of batteries to soc_quantum and import/export prices to price_quantum
+        (e.g. sensor precision and price tick). Plans are solved from the rounded inputs, so a cached plan is exactly
+        the plan for its key.
+        Args:
+          max_entries: number of plans kept in memory; the least recently used plan is evicted first.
+          ttl_seconds: plans older than this are not returned (None keeps plans until evicted).
+          path: optional directory where plans are also stored as .npz files, surviving restarts.
+          backend, solver: passed to EnergyOptimizer and its solve().
+          clock: source of the current time in seconds, time.time by default so that stored plans expire across restarts.
+        hits, misses, evictions and expirations count cache events; disk_hits counts the hits served from path.
+        """
+        assert max_entries > 0
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.soc_quantum = soc_quantum
+        self.price_quantum = price_quantum
+        self.path = path
+        self.backend = backend
+        self.solver = solver
+        self.clock = clock
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        # key -> (creation time, plan), in least to most recently used order.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def normalize(self, devices):
+        """
+        Returns device definitions with initial_soc and prices rounded to the configured quanta.
+        """
+        res = []
+        for method_name, kwargs in devices:
+            kwargs = dict(kwargs)
+            if method_name == 'add_battery':
+                kwargs['initial_soc'] = float(_quantize(kwargs['initial_soc'], self.soc_quantum))
+            elif method_name == 'add_mains_electricity_supply':
+                for arg in ['import_hourly_prices', 'export_hourly_prices']:
+                    if kwargs.get(arg) is not None:
+                        kwargs[arg] = _quantize(kwargs[arg], self.price_quantum)
+            res.append((method_name, kwargs))
+        return res
+
+    def key(self, n_hours, devices, step_hours=None):
+        """
+        Returns the cache key of a plan request as a hex digest.
+        """
+        canonical = {'n_hours': n_hours, 'step_hours': _canonical(step_hours), 'backend': self.backend,
+            'devices': [[method_name, _canonical(kwargs)] for method_name, kwargs in self.normalize(devices)]}
+        return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+    def get_plan(self, n_hours, devices, step_hours=None):
+        """
+        Returns the plan (as returned by EnergyOptimizer.get_time_series) for device definitions
+        (method_name, kwargs) as accepted by EnergyOptimizer.from_devices, solving it only on a cache miss.
+        Returned arrays are shared between callers and read-only.
+        Raises ValueError if the model has no feasible plan; failed plans are not cached.
+        """
+        key = self.key(n_hours, devices, step_hours)
+        plan = self._lookup(key)
+        if plan is not None:
+            return plan
+        optimizer = EnergyOptimizer.from_devices(n_hours, self.normalize(devices), backend=self.backend, step_hours=step_hours)
+        result = optimizer.solve(solver=self.solver)
+        if not result.has_solution:
+            raise ValueError("No feasible plan: %s" % result.status)
+        plan = optimizer.get_time_series()
+        for device_series in plan.values():
+            for values in device_series.values():
+                values.flags.writeable = False
+        created = self.clock()
+        self._store(key, created, plan)
+        if self.path is not None:
+            self._save(key, created, plan)
+        return plan
+
+    def _expired(self, created):
+        return self.ttl_seconds is not None and self.clock() - created > self.ttl_seconds
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._expired(entry[0]):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+                self.expirations += 1
+        entry = self._load(key) if self.path is not None else None
+        if entry is not None:
+            with self._lock:
+                self.hits += 1
+                self.disk_hits += 1
+            self._store(key, *entry)
+            return entry[1]
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _store(self, key, created, plan):
+        with self._lock:
+            self._entries[key] = (created, plan)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def _save(self, key, created, plan):
+        # Write to a temporary file of this writer first, so that a concurrent reader never sees a partial plan
+        # and concurrent writers of the same plan, in this or other processes, do not share a file.
+        with tempfile.NamedTemporaryFile(dir=self.path, prefix=key + '.', suffix='.tmp', delete=False) as f:
+            storage.save_plan(f, plan, created=created)
+        os.replace(f.name, self._file(key))
+
+    def _load(self, key):
+        try:
+            plan, metadata = storage.load_plan(self._file(key), with_metadata=True)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Ignoring unreadable cached plan %s: %s", key, e)
+            return None
+        created = float(metadata['created'])
+        if self._expired(created):
+            os.remove(self._file(key))
+            with self._lock:
+                self.expirations += 1
+            return None
+        return created, plan
+
+    def clear(self):
+        """
+        Drops all plans kept in memory. Plans stored on disk are kept.
+        """
+        with self._lock:
+            self._entries.clear()
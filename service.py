@@ -0,0 +1,210 @@
+"""
+Asyncio dispatch service on top of EnergyOptimizer.
+Telemetry (SOC, consumption forecasts) and price publications arrive as async streams. Every update triggers
+a re-plan of the affected homes; solves run in an executor with bounded concurrency so that ingestion is
+never blocked, and a plan is dropped if newer data for its home arrived in the meantime. Published plans
+carry the battery command of every hour in the README convention: positive number is the charge rate in kW,
+0 is idle and negative number is a discharge.
+"""
+import asyncio
+import copy
+import logging
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from optim import EnergyOptimizer
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Telemetry:
+    """
+    Update of one home: device name -> {add_* argument: new value}, e.g. {'battery': {'initial_soc': 7.5}}.
+    """
+    home: str
+    updates: dict
+
+
+@dataclass
+class PricePublication:
+    """
+    New prices for all homes, set as argument of the supply device (import prices of 'mains' by default).
+    """
+    prices: list
+    hour_titles: list = None
+    supply: str = 'mains'
+    argument: str = 'import_hourly_prices'
+
+
+@dataclass
+class PlanUpdate:
+    """
+    Plan of one home. commands are battery charge (+) / discharge (-) rates per hour, soc the projected
+    state of charge at the end of each hour and series the full result of get_time_series.
+    """
+    home: str
+    version: int
+    hour_titles: list
+    commands: np.ndarray
+    soc: np.ndarray
+    series: dict = field(repr=False)
+
+    def command_names(self, atol=1e-6):
+        """
+        Returns 'Charge', 'Idle' or 'Discharge' for every hour.
+        """
+        return ['Charge' if c > atol else 'Discharge' if c < -atol else 'Idle' for c in self.commands]
+
+
+def _solve_plan(n_hours, devices, backend, solver, step_hours):
+    """
+    Builds and solves one plan; runs in the executor. Returns get_time_series() or None if there is no plan.
+    """
+    optimizer = EnergyOptimizer.from_devices(n_hours, devices, backend=backend, step_hours=step_hours)
+    result = optimizer.solve(solver=solver)
+    if not result.has_solution:
+        return None
+    return optimizer.get_time_series()
+
+
+async def fake_feed(items, delay=0.0):
+    """
+    In-process feed yielding items with a delay between them, for tests and local runs.
+    """
+    for item in items:
+        await asyncio.sleep(delay)
+        yield item
+
+
+class DispatchService():
+
+    def __init__(self, homes, n_hours, battery='battery', max_concurrency=2, executor=None, backend='pulp',
+            solver=None, step_hours=None):
+        """
+        Args:
+          homes: dict home -> device definitions (method_name, kwargs) as accepted by EnergyOptimizer.from_devices.
+            Telemetry and price publications replace kwargs of these definitions.
+          n_hours: planning horizon of all homes.
+          battery: name of the battery device whose charge and discharge rates form the command.
+          max_concurrency: maximal number of solves running at the same time.
+          executor: concurrent.futures executor for the solves; the event loop default executor if None.
+            A ProcessPoolExecutor keeps the event loop responsive even for solvers holding the GIL.
+          backend, solver, step_hours: passed to EnergyOptimizer and its solve().
+        """
+        self.homes = {home: [(method_name, dict(kwargs)) for method_name, kwargs in devices] for home, devices in homes.items()}
+        self.n_hours = n_hours
+        self.battery = battery
+        self.max_concurrency = max_concurrency
+        self.executor = executor
+        self.backend = backend
+        self.solver = solver
+        self.step_hours = step_hours
+        self.hour_titles = None
+        # Latest plan of every home.
+        self.plans = {}
+        # Counters of finished solves and of solves dropped because newer data arrived.
+        self.solves = 0
+        self.dropped = 0
+        self._versions = {home: 0 for home in homes}
+        self._tasks = {}
+        self._subscribers = []
+        self._semaphore = None
+
+    def subscribe(self):
+        """
+        Returns a queue receiving every published PlanUpdate.
+        """
+        queue = asyncio.Queue()
+        self._subscribers.append(queue)
+        return queue
+
+    def current_command(self, home, hour=0):
+        """
+        Returns the battery command of an hour of the latest plan of a home, or None if it has no plan yet.
+        """
+        plan = self.plans.get(home)
+        return None if plan is None else float(plan.commands[hour])
+
+    def apply_telemetry(self, telemetry):
+        self._update(telemetry.home, telemetry.updates)
+
+    def apply_prices(self, publication):
+        assert len(publication.prices) == self.n_hours
+        self.hour_titles = publication.hour_titles
+        for home in self.homes:
+            self._update(home, {publication.supply: {publication.argument: publication.prices}})
+
+    def _update(self, home, updates):
+        for method_name, kwargs in self.homes[home]:
+            if kwargs['name'] in updates:
+                kwargs.update(updates[kwargs['name']])
+        self._versions[home] += 1
+        task = self._tasks.get(home)
+        if task is None or task.done():
+            self._tasks[home] = asyncio.get_running_loop().create_task(self._plan(home))
+
+    async def _plan(self, home):
+        """
+        Plans a home until a plan for its latest data is published.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        loop = asyncio.get_running_loop()
+        while True:
+            version = self._versions[home]
+            async with self._semaphore:
+                if self._versions[home] != version:
+                    # Newer data arrived while waiting for a free solver.
+                    self.dropped += 1
+                    continue
+                devices = copy.deepcopy(self.homes[home])
+                try:
+                    series = await loop.run_in_executor(self.executor, _solve_plan, self.n_hours, devices,
+                        self.backend, self.solver, self.step_hours)
+                except Exception:
+                    logger.exception("Planning home %s failed", home)
+                    series = None
+            self.solves += 1
+            if self._versions[home] != version:
+                self.dropped += 1
+                continue
+            if series is None:
+                logger.warning("No feasible plan for home %s", home)
+                return
+            battery = series[self.battery]
+            plan = PlanUpdate(home=home, version=version, hour_titles=self.hour_titles,
+                commands=battery['charge_rate'] + battery['discharge_rate'], soc=battery['soc'], series=series)
+            self.plans[home] = plan
+            for queue in self._subscribers:
+                queue.put_nowait(plan)
+            return
+
+    async def ingest_telemetry(self, stream):
+        async for telemetry in stream:
+            self.apply_telemetry(telemetry)
+
+    async def ingest_prices(self, stream):
+        async for publication in stream:
+            self.apply_prices(publication)
+
+    async def drain(self):
+        """
+        Waits until all homes are planned for their latest data.
+        """
+        while any(not task.done() for task in self._tasks.values()):
+            await asyncio.gather(*self._tasks.values())
+
+    async def run(self, telemetry=None, prices=None):
+        """
+        Consumes the telemetry and price streams until they end, then waits for the outstanding plans.
+        """
+        streams = []
+        if telemetry is not None:
+            streams.append(self.ingest_telemetry(telemetry))
+        if prices is not None:
+            streams.append(self.ingest_prices(prices))
+        await asyncio.gather(*streams)
+        await self.drain()
@@ -0,0 +1,191 @@
+"""
+Scenario-weighted planning over forecast ensembles in a single model.
+Every scenario gets its own copy of the deterministic model with its own forecasts. Decisions of the first
+shared_steps steps (battery charging and discharging, flexible and heating consumption) must be equal in all
+scenarios, as they are taken before it is known which scenario happens; later steps may differ.
+The expected cost over the scenarios is minimized, optionally together with the conditional value at risk (CVaR)
+of the cost. The deterministic model is built once; its constraint matrix, bounds and costs are replicated for all
+scenarios with array operations, so build time grows linearly with the number of scenarios.
+"""
+import time
+
+import numpy as np
+
+from optim import EnergyOptimizer, MatrixModel, SolveResult, solve_matrix_model
+
+
+# Series decided before the scenario is known, for devices added with these methods.
+DECISIONS = {
+    'add_battery': ['charge_rate', 'discharge_rate'],
+    'add_flexible_consumption': ['consumption'],
+    'add_heating_consumption': ['consumption'],
+}
+
+
+class ScenarioOptimizer():
+
+    def __init__(self, n_hours, devices, forecasts, weights=None, shared_steps=1, cvar_alpha=None, cvar_weight=0.0,
+            step_hours=None):
+        """
+        Args:
+          n_hours: number of time steps.
+          devices: device definitions (method_name, kwargs) as accepted by EnergyOptimizer.from_devices.
+          forecasts: dict device name -> array (scenario, hour) of forecasts, given as to update_forecast,
+            e.g. {'solar': solar_ensemble, 'consumption': consumption_ensemble}. All arrays have the same number of scenarios.
+          weights: probabilities of the scenarios; equal weights by default. Normalized to sum to one.
+          shared_steps: number of first steps whose decisions (see DECISIONS) are equal in all scenarios.
+          cvar_alpha: confidence level of the CVaR term, e.g. 0.9 for the mean cost of the worst 10% of scenarios.
+          cvar_weight: weight of the CVaR term in the objective; 0 minimizes the expected cost only.
+          step_hours: see EnergyOptimizer.
+        The model is solved with scipy.optimize.milp (HiGHS).
+        """
+        assert len(forecasts) > 0
+        forecasts = {name: np.asarray(values, dtype=np.float64) for name, values in forecasts.items()}
+        self.n_scenarios = len(next(iter(forecasts.values())))
+        assert all(values.shape == (self.n_scenarios, n_hours) for values in forecasts.values())
+        if weights is None:
+            weights = np.ones(self.n_scenarios)
+        weights = np.asarray(weights, dtype=np.float64)
+        assert weights.shape == (self.n_scenarios,) and np.all(weights >= 0) and weights.sum() > 0
+        self.weights = weights / weights.sum()
+        assert 0 <= shared_steps <= n_hours
+        use_cvar = cvar_alpha is not None and cvar_weight > 0
+        if use_cvar:
+            assert 0 <= cvar_alpha < 1
+        self.n_hours = n_hours
+        self.shared_steps = shared_steps
+        self.cvar_alpha = cvar_alpha
+        self.cvar_weight = cvar_weight
+        self.stats = None
+        self._solution = None
+
+        start = time.perf_counter()
+        base = EnergyOptimizer.from_devices(n_hours, devices, backend='scipy', step_hours=step_hours)
+        self.base = base
+        self._columns = base.get_columns()
+        n_vars, n_rows, n_scenarios = base.n_vars, base.n_rows, self.n_scenarios
+
+        # Bounds and cost constants of every scenario, set through the update method of the base model.
+        lower = np.empty((n_scenarios, n_vars))
+        upper = np.empty((n_scenarios, n_vars))
+        self._scenario_offsets = np.empty(n_scenarios)
+        for scenario in range(n_scenarios):
+            for name, values in forecasts.items():
+                base.update_forecast(name, values[scenario])
+            model = base.get_matrix_model()
+            lower[scenario] = model.lower
+            upper[scenario] = model.upper
+            self._scenario_offsets[scenario] = model.cost_offset
+        self._base_cost = model.cost
+
+        # Block diagonal matrix of the scenario models.
+        scenario_ids = np.arange(n_scenarios)[:, None]
+        rows = [(model.rows + scenario_ids * n_rows).ravel()]
+        cols = [(model.cols + scenario_ids * n_vars).ravel()]
+        coeffs = [np.tile(model.coeffs, n_scenarios)]
+        row_lower = [np.tile(model.row_lower, n_scenarios)]
+        row_upper = [np.tile(model.row_upper, n_scenarios)]
+        self.n_rows = n_scenarios * n_rows
+
+        # Non-anticipativity: shared decisions of every scenario equal those of the first scenario.
+        self._decisions = [(kwargs['name'], var_name) for method_name, kwargs in base.get_devices()
+            for var_name in DECISIONS.get(method_name, [])]
+        shared = [self._columns[name][var_name][:shared_steps] for name, var_name in self._decisions]
+        shared = np.concatenate(shared) if shared else np.zeros(0, dtype=np.int64)
+        n_shared = (n_scenarios - 1) * len(shared)
+        if n_shared > 0:
+            na_rows = self.n_rows + np.arange(n_shared)
+            rows += [na_rows, na_rows]
+            cols += [(shared + scenario_ids[1:] * n_vars).ravel(), np.tile(shared, n_scenarios - 1)]
+            coeffs += [np.ones(n_shared), -np.ones(n_shared)]
+            row_lower.append(np.zeros(n_shared))
+            row_upper.append(np.zeros(n_shared))
+            self.n_rows += n_shared
+
+        self.n_vars = n_scenarios * n_vars
+        cost = (self.weights[:, None] * model.cost).ravel()
+        self._cost_offset = float(self.weights @ self._scenario_offsets)
+        lower, upper = lower.ravel(), upper.ravel()
+        integrality = np.tile(model.integrality, n_scenarios)
+        if use_cvar:
+            # CVaR = eta + sum(weight * excess) / (1 - alpha) with excess >= scenario cost - eta, excess >= 0.
+            eta = self.n_vars
+            excess = self.n_vars + 1 + np.arange(n_scenarios)
+            self.n_vars += 1 + n_scenarios
+            cost = np.concatenate([cost, [cvar_weight], cvar_weight * self.weights / (1 - cvar_alpha)])
+            lower = np.concatenate([lower, [-np.inf], np.zeros(n_scenarios)])
+            upper = np.concatenate([upper, np.full(1 + n_scenarios, np.inf)])
+            integrality = np.concatenate([integrality, np.zeros(1 + n_scenarios, dtype=integrality.dtype)])
+            cost_cols = np.flatnonzero(model.cost)
+            cvar_rows = self.n_rows + np.arange(n_scenarios)
+            rows += [np.repeat(cvar_rows, len(cost_cols)), cvar_rows, cvar_rows]
+            cols += [(cost_cols + scenario_ids * n_vars).ravel(), np.full(n_scenarios, eta), excess]
+            coeffs += [np.tile(model.cost[cost_cols], n_scenarios), -np.ones(n_scenarios), -np.ones(n_scenarios)]
+            row_lower.append(np.full(n_scenarios, -np.inf))
+            row_upper.append(-self._scenario_offsets)
+            self.n_rows += n_scenarios
+        self._model = MatrixModel(cost=cost, cost_offset=self._cost_offset, lower=lower, upper=upper, integrality=integrality,
+            rows=np.concatenate(rows), cols=np.concatenate(cols), coeffs=np.concatenate(coeffs),
+            row_lower=np.concatenate(row_lower), row_upper=np.concatenate(row_upper))
+        self._base_vars = n_vars
+        self.build_time = time.perf_counter() - start
+
+    def model_type(self):
+        return 'MILP' if np.any(self._model.integrality) else 'LP'
+
+    def solve(self, verbose=False, solver=None):
+        """
+        Solves the scenario model. solver is a SolverConfig or a solver name; only HiGHS is supported.
+        Solver status, model size and timings are available in self.stats afterwards. Returns a SolveResult.
+        """
+        solution, self.stats = solve_matrix_model(self._model, solver, verbose, build_time={'scenarios': self.build_time})
+        has_solution = solution is not None
+        self._solution = solution if has_solution else np.full(self.n_vars, np.nan)
+        objective = float(self._model.cost @ self._solution + self._cost_offset) if has_solution else np.nan
+        return SolveResult(status=self.stats.status, objective=objective, solve_time=self.stats.solve_time,
+            has_solution=has_solution)
+
+    def _scenario_solutions(self):
+        return self._solution[:self.n_scenarios * self._base_vars].reshape(self.n_scenarios, self._base_vars)
+
+    def get_time_series(self):
+        """
+        Returns a nested dictionary device -> variable -> np ndarray of shape (scenario, hour).
+        """
+        values = self._scenario_solutions().astype(np.float32)
+        return {device_name: {var_name: values[:, cols] for var_name, cols in device_columns.items()}
+            for device_name, device_columns in self._columns.items()}
+
+    def get_first_step(self):
+        """
+        Returns the decisions shared by all scenarios as a nested dictionary device -> variable -> np ndarray
+        of the first shared_steps values.
+        """
+        first = self._scenario_solutions()[0]
+        res = {}
+        for name, var_name in self._decisions:
+            res.setdefault(name, {})[var_name] = first[self._columns[name][var_name][:self.shared_steps]].astype(np.float32)
+        return res
+
+    def get_scenario_costs(self):
+        """
+        Returns the total cost of the plan in every scenario.
+        """
+        return self._scenario_solutions() @ self._base_cost + self._scenario_offsets
+
+    def get_expected_cost(self):
+        return float(self.weights @ self.get_scenario_costs())
+
+    def get_cvar(self, alpha=None):
+        """
+        Returns the weighted mean cost of the worst 1 - alpha share of scenarios (by default alpha is cvar_alpha).
+        """
+        alpha = self.cvar_alpha if alpha is None else alpha
+        assert alpha is not None and 0 <= alpha < 1
+        costs = self.get_scenario_costs()
+        order = np.argsort(costs)[::-1]
+        tail = 1 - alpha
+        # Weight of every scenario within the tail, worst scenarios first.
+        cumulative = np.cumsum(self.weights[order])
+        in_tail = np.clip(tail - (cumulative - self.weights[order]), 0, self.weights[order])
+        return float(in_tail @ costs[order] / tail)
@@ -0,0 +1,80 @@
+"""
+Compact binary storage of device configurations and plans as uncompressed NumPy .npz files.
+Only NumPy is imported, so controllers can load a stored configuration or plan in milliseconds without
+importing the optimizer backends; pulp is imported only when a model is solved with the pulp backend.
+
+A plan (as returned by EnergyOptimizer.get_time_series) is stored as one (series, hour) float32 matrix
+with the "device/variable" name of every row, and is loaded as views into that matrix.
+A configuration is stored as JSON of the device definitions (see EnergyOptimizer.get_devices) with
+all series arguments replaced by references to float64 arrays.
+"""
+import json
+
+import numpy as np
+
+
+def save_plan(file, plan, **metadata):
+    """
+    Stores a plan, a nested dictionary device -> variable -> np.ndarray with one value per hour.
+    metadata: scalar values stored with the plan, e.g. created=time.time() or objective=result.objective.
+    file: path or open binary file.
+    """
+    names = [device_name + '/' + var_name for device_name, device_series in plan.items() for var_name in device_series]
+    values = np.array([values for device_series in plan.values() for values in device_series.values()], dtype=np.float32)
+    np.savez(file, names=np.array(names), values=values, **{'_' + key: value for key, value in metadata.items()})
+
+
+def load_plan(file, with_metadata=False):
+    """
+    Loads a plan stored with save_plan. Returns the plan, or (plan, metadata) if with_metadata is True.
+    Arrays of the plan are read-only views into one matrix.
+    """
+    with np.load(file, allow_pickle=False) as data:
+        values = data['values']
+        values.flags.writeable = False
+        plan = {}
+        for name, series in zip(data['names'].tolist(), values):
+            device_name, var_name = name.split('/', 1)
+            plan.setdefault(device_name, {})[var_name] = series
+        if not with_metadata:
+            return plan
+        metadata = {key[1:]: data[key][()] for key in data.files if key.startswith('_')}
+        return plan, metadata
+
+
+def save_devices(file, n_hours, devices, step_hours=None):
+    """
+    Stores a model configuration: n_hours, device definitions (method_name, kwargs) as accepted by
+    EnergyOptimizer.from_devices and optionally step_hours.
+    """
+    arrays = {}
+    definitions = []
+    for index, (method_name, kwargs) in enumerate(devices):
+        scalars = {}
+        for arg, value in kwargs.items():
+            if np.ndim(value) > 0:
+                key = '%d/%s' % (index, arg)
+                arrays[key] = np.asarray(value, dtype=np.float64)
+                scalars[arg] = {'array': key}
+            else:
+                scalars[arg] = value.item() if isinstance(value, np.generic) else value
+        definitions.append([method_name, scalars])
+    config = {'n_hours': n_hours, 'devices': definitions}
+    if step_hours is not None:
+        arrays['step_hours'] = np.broadcast_to(np.asarray(step_hours, dtype=np.float64), (n_hours,))
+    np.savez(file, config=np.array(json.dumps(config)), **arrays)
+
+
+def load_devices(file):
+    """
+    Loads a configuration stored with save_devices. Returns a dict with n_hours, devices and step_hours,
+    e.g. EnergyOptimizer.from_devices(**load_devices(path)).
+    """
+    with np.load(file, allow_pickle=False) as data:
+        config = json.loads(data['config'][()])
+        devices = []
+        for method_name, scalars in config['devices']:
+            kwargs = {arg: data[value['array']] if isinstance(value, dict) else value for arg, value in scalars.items()}
+            devices.append((method_name, kwargs))
+        step_hours = data['step_hours'] if 'step_hours' in data.files else None
+    return {'n_hours': config['n_hours'], 'devices': devices, 'step_hours': step_hours}
@@ -0,0 +1,72 @@
+from backtest import backtest, iter_windows, parameter_grid, sweep
+from optim import EnergyOptimizer
+import numpy as np
+import pandas as pd
+import pytest
+
+
+battery = dict(capacity=10, initial_soc=2, efficiency=0.95, max_charge_power=5, max_discharge_power=5,
+    cost_of_cycle_kwh=1, final_energy_value_per_kwh=12)
+
+
+def history(n_hours, seed=0):
+    rng = np.random.default_rng(seed)
+    hour_of_day = np.arange(n_hours) % 24
+    return {
+        'price': 12 + 5 * np.sin((hour_of_day - 7) / 24 * 2 * np.pi) + rng.uniform(-2, 2, n_hours),
+        'consumption': 0.8 + rng.uniform(0, 1.0, n_hours),
+        'solar': np.clip(4 * np.sin((hour_of_day - 6) / 14 * np.pi), 0, None),
+        'export_price': np.full(n_hours, 4.0),
+    }
+
+
+def test_iter_windows(tmp_path):
+    data = history(60)
+    data['home'] = np.where(np.arange(60) % 2 == 0, 'a', 'b')
+    path = tmp_path / 'history.csv'
+    pd.DataFrame(data).to_csv(path, index=False)
+    windows = list(iter_windows(path, 24, chunk_rows=7))
+    assert [len(w['price']) for w in windows] == [24, 24, 12]
+    np.testing.assert_allclose(windows[1]['consumption'], data['consumption'][24:48])
+    windows = list(iter_windows(path, 24, home='b', chunk_rows=7))
+    assert [len(w['price']) for w in windows] == [24, 6]
+    np.testing.assert_allclose(windows[0]['price'], data['price'][1:48:2])
+    with pytest.raises(ValueError, match='no home column'):
+        list(iter_windows(history(60), 24, home='b'))
+
+
+def test_backtest_carries_soc_forward():
+    data = history(48)
+    result = backtest(data, battery, max_export_power=5)
+    assert result.n_windows == 2 and result.n_hours == 48
+    # Same plans by hand, starting the second day from the end of the first.
+    soc = battery['initial_soc']
+    grid_cost = 0.0
+    for day in range(2):
+        hours = slice(24 * day, 24 * day + 24)
+        optimizer = EnergyOptimizer(24)
+        optimizer.add_mains_electricity_supply(name='mains', max_import_power=100, import_hourly_prices=data['price'][hours],
+            max_export_power=5, export_hourly_prices=data['export_price'][hours])
+        optimizer.add_fixed_consumption(name='consumption', hourly_consumption=data['consumption'][hours])
+        optimizer.add_solar_production(name='solar', estimated_hourly_production=data['solar'][hours])
+        optimizer.add_battery(name='battery', **dict(battery, initial_soc=soc))
+        optimizer.solve()
+        soc = optimizer.get_time_series()['battery']['soc'][-1]
+        assert np.isclose(result.final_soc[day], soc, atol=1e-4)
+        grid_cost += optimizer.get_hourly_costs()['mains'].sum()
+    assert np.isclose(result.grid_cost, grid_cost, rtol=1e-5)
+    assert result.savings > 0
+    assert np.isclose(result.cycles, result.charged_kwh / battery['capacity'])
+    assert result.discharged_kwh > 0
+
+
+def test_sweep():
+    data = history(72, seed=1)
+    batteries = parameter_grid(battery, capacity=[5, 15], cost_of_cycle_kwh=[0, 2])
+    assert len(batteries) == 4
+    results = sweep(data, batteries, max_workers=2)
+    assert [r.battery for r in results] == batteries
+    for result, expected in zip(results, sweep(data, batteries, max_workers=1)):
+        assert np.isclose(result.savings, expected.savings)
+    # A larger battery saves at least as much at equal cycle cost.
+    assert results[2].savings >= results[0].savings - 1e-6
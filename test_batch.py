@@ -0,0 +1,63 @@
+from batch import solve_scenarios, structure_key, update_or_build
+from optim import EnergyOptimizer
+import numpy as np
+
+
+def make_scenario(solar_scale, initial_soc):
+    prices = [15, 18, 19, 10, 10, 10, 10, 10, 15, 15, 10, 12, 14, 15, 15, 13, 14, 12, 15, 14, 13, 11, 10, 13]
+    consumption = [1, 1, 2, 1, 1, 1, 2, 1, 2, 5, 1, 2, 3, 4, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
+    solar = [0, 0, 0, 1, 4, 8, 8, 9, 9, 8, 6, 4, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+    return [
+        ('add_mains_electricity_supply', dict(name='mains', max_import_power=10, import_hourly_prices=prices,
+            max_export_power=9, export_hourly_prices=[9] * len(prices))),
+        ('add_fixed_consumption', dict(name='consumption', hourly_consumption=consumption)),
+        ('add_solar_production', dict(name='solar', estimated_hourly_production=np.array(solar) * solar_scale)),
+        ('add_battery', dict(name='battery', capacity=15, initial_soc=initial_soc, efficiency=0.95, max_charge_power=5,
+            max_discharge_power=10, cost_of_cycle_kwh=1, final_energy_value_per_kwh=12)),
+    ]
+
+
+def test_structure_key():
+    assert structure_key(make_scenario(1.0, 10)) == structure_key(make_scenario(0.5, 3))
+    other = make_scenario(1.0, 10)
+    other[3][1]['capacity'] = 20
+    assert structure_key(other) != structure_key(make_scenario(1.0, 10))
+
+
+def test_solve_scenarios():
+    scenarios = [make_scenario(scale, soc) for scale, soc in [(1.0, 10), (0.5, 10), (0.2, 3), (1.2, 0)]]
+    for max_workers in [1, 2]:
+        series, costs = solve_scenarios(24, scenarios, max_workers=max_workers)
+        assert series['battery']['soc'].shape == (len(scenarios), 24)
+        for index, devices in enumerate(scenarios):
+            optimizer = EnergyOptimizer.from_devices(24, devices)
+            optimizer.solve()
+            np.testing.assert_allclose(costs[index], optimizer.get_total_cost(), rtol=1e-6)
+            np.testing.assert_allclose(series['consumption']['consumption'][index],
+                optimizer.get_time_series()['consumption']['consumption'])
+
+
+def test_solve_scenarios_without_export():
+    # Export prices listed for a supply that cannot export are ignored, also when updating a shared model.
+    scenarios = []
+    for soc in [10, 3]:
+        devices = make_scenario(1.0, soc)
+        devices[0][1]['max_export_power'] = 0
+        scenarios.append(devices)
+    _, costs = solve_scenarios(24, scenarios, max_workers=1)
+    for index, devices in enumerate(scenarios):
+        optimizer = EnergyOptimizer.from_devices(24, devices)
+        optimizer.solve()
+        np.testing.assert_allclose(costs[index], optimizer.get_total_cost(), rtol=1e-6)
+
+
+def test_update_or_build():
+    optimizer, updated = update_or_build(None, 24, make_scenario(1.0, 10), backend='scipy')
+    assert not updated
+    same, updated = update_or_build(optimizer, 24, make_scenario(0.5, 3), backend='scipy')
+    assert same is optimizer and updated
+    assert optimizer.get_devices()[3][1]['initial_soc'] == 3
+    shorter = [(method_name, {arg: value[:12] if np.ndim(value) > 0 else value for arg, value in kwargs.items()})
+        for method_name, kwargs in make_scenario(1.0, 10)]
+    other, updated = update_or_build(optimizer, 12, shorter, backend='scipy')
+    assert other is not optimizer and other.n_hours == 12 and not updated
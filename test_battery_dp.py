@@ -0,0 +1,68 @@
+from battery_dp import dispatch_battery
+from optim import EnergyOptimizer
+import numpy as np
+import pytest
+
+
+prices = [15, 18, 19, 10, 10, 10, 10, 10, 10, 10, 10, 12, 14, 15, 15, 13, 14, 12, 15, 14, 13, 11, 10, 13]
+consumption = [1, 1, 2, 1, 1, 1, 2, 1, 2, 5, 1, 2, 3, 14, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
+min_soc = [0] * 6 + [5] * 18
+max_soc = [15] * 12 + [10] * 12
+
+
+def plan_cost(series, efficiency, cost_of_cycle_kwh, final_energy_value_per_kwh):
+    return float(np.sum(series['mains']['import'].astype(np.float64) * prices)
+        + np.sum(series['battery']['charge_rate'].astype(np.float64)) * cost_of_cycle_kwh
+        - series['battery']['soc'][-1] * efficiency * final_energy_value_per_kwh)
+
+
+def solve_lp(efficiency):
+    optimizer = EnergyOptimizer(len(prices))
+    optimizer.add_mains_electricity_supply(name='mains', max_import_power=10, import_hourly_prices=prices)
+    optimizer.add_battery(name='battery', capacity=15, initial_soc=10, efficiency=efficiency, max_charge_power=5,
+        max_discharge_power=15, cost_of_cycle_kwh=1, final_energy_value_per_kwh=12, min_soc=min_soc, max_soc=max_soc)
+    optimizer.add_fixed_consumption(name='consumption', hourly_consumption=consumption)
+    optimizer.solve()
+    return optimizer
+
+
+@pytest.mark.parametrize('efficiency, soc_step, tolerance', [(1.0, 0.5, 1e-6), (0.95, 0.05, 0.1)])
+def test_dispatch_battery_matches_lp(efficiency, soc_step, tolerance):
+    series = dispatch_battery(prices, consumption, capacity=15, initial_soc=10, efficiency=efficiency,
+        max_charge_power=5, max_discharge_power=15, cost_of_cycle_kwh=1, final_energy_value_per_kwh=12,
+        min_soc=min_soc, max_soc=max_soc, max_import_power=10, soc_step=soc_step)
+    optimizer = solve_lp(efficiency)
+    lp_series = optimizer.get_time_series()
+    assert series.keys() == lp_series.keys()
+    for device_name in series:
+        assert series[device_name].keys() <= lp_series[device_name].keys()
+
+    # Same constraints as the LP plan.
+    soc = series['battery']['soc']
+    assert np.all(soc >= np.array(min_soc) - 1e-6) and np.all(soc <= np.array(max_soc) + 1e-6)
+    assert np.all(series['mains']['import'] <= 10 + 1e-6)
+    np.testing.assert_allclose(series['mains']['import'] + series['mains']['export'] - series['battery']['charge_rate']
+        - series['battery']['discharge_rate'] * efficiency, consumption, atol=1e-5)
+
+    cost = plan_cost(series, efficiency, 1, 12)
+    lp_cost = optimizer.get_total_cost()
+    assert cost >= lp_cost - 1e-4
+    assert cost <= lp_cost + tolerance
+
+
+def test_dispatch_battery_infeasible():
+    with pytest.raises(ValueError):
+        dispatch_battery(prices, [30] * 24, capacity=15, initial_soc=10, efficiency=1, max_charge_power=5,
+            max_discharge_power=5, cost_of_cycle_kwh=1, final_energy_value_per_kwh=12, max_import_power=10)
+
+
+def test_dispatch_battery_time_steps():
+    # 15 minute steps with prices and consumption repeated within each hour cost the same as hourly steps.
+    hourly = dispatch_battery(prices, consumption, capacity=15, initial_soc=10, efficiency=1, max_charge_power=5,
+        max_discharge_power=15, cost_of_cycle_kwh=1, final_energy_value_per_kwh=12, max_import_power=10, soc_step=0.25)
+    quarter = dispatch_battery(np.repeat(prices, 4), np.repeat(consumption, 4), capacity=15, initial_soc=10, efficiency=1,
+        max_charge_power=5, max_discharge_power=15, cost_of_cycle_kwh=1, final_energy_value_per_kwh=12,
+        max_import_power=10, soc_step=0.25, step_hours=0.25)
+    quarter_cost = float(np.sum(quarter['mains']['import'].astype(np.float64) * np.repeat(prices, 4)) * 0.25
+        + np.sum(quarter['battery']['charge_rate'].astype(np.float64)) * 0.25 - quarter['battery']['soc'][-1] * 12)
+    np.testing.assert_allclose(quarter_cost, plan_cost(hourly, 1, 1, 12), rtol=1e-6)
@@ -0,0 +1,27 @@
+from benchmark import DEVICES, build_model, run_benchmark, synthetic_profiles
+import json
+
+
+def test_build_model_devices():
+    optimizer = build_model(48, len(DEVICES), synthetic_profiles(48))
+    assert list(optimizer.vars) == DEVICES
+
+
+def test_run_benchmark(tmp_path):
+    output = tmp_path / 'results.jsonl'
+    results = run_benchmark(horizons=[24, 48], device_counts=[1, 6], label='test', output=output)
+    lines = [json.loads(line) for line in output.read_text().splitlines()]
+    assert lines == results
+    assert [(r['n_hours'], r['n_devices']) for r in results] == [(24, 1), (24, 6), (48, 1), (48, 6)]
+    for r in results:
+        assert r['status'] == 'Optimal'
+        assert r['label'] == 'test'
+        assert r['peak_memory_bytes'] > 0
+
+
+def test_run_benchmark_steps():
+    results = run_benchmark(horizons=[24], device_counts=[2], backend='scipy', memory=False, step_hours=[1.0, 0.25])
+    assert [(r['step_hours'], r['n_steps']) for r in results] == [(1.0, 24), (0.25, 96)]
+    assert all(r['status'] == 'Optimal' and r['pulp_version'] is None for r in results)
+    # Same daily consumption profile at a finer resolution costs about the same.
+    assert abs(results[1]['objective'] - results[0]['objective']) < 0.02 * results[0]['objective']
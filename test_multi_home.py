@@ -0,0 +1,52 @@
+from multi_home import MultiHomeOptimizer
+from optim import EnergyOptimizer
+import numpy as np
+
+
+prices = np.array([15, 18, 19, 10, 10, 10, 10, 10, 15, 15, 10, 12, 14, 15, 15, 13, 14, 12, 15, 14, 13, 11, 10, 13], dtype=float)
+
+
+def make_home(seed):
+    rng = np.random.default_rng(seed)
+    return [
+        ('add_mains_electricity_supply', dict(name='mains', max_import_power=10, import_hourly_prices=prices)),
+        ('add_fixed_consumption', dict(name='consumption', hourly_consumption=1 + rng.uniform(0, 2, 24))),
+        ('add_battery', dict(name='battery', capacity=10, initial_soc=2, efficiency=0.95, max_charge_power=5,
+            max_discharge_power=5, cost_of_cycle_kwh=1, final_energy_value_per_kwh=12)),
+    ]
+
+
+def test_independent_homes():
+    homes = {name: make_home(seed) for seed, name in enumerate(['a', 'b'])}
+    optimizer = MultiHomeOptimizer(24, homes)
+    result = optimizer.solve()
+    costs = []
+    for devices in homes.values():
+        home = EnergyOptimizer.from_devices(24, devices, backend='scipy')
+        home.solve()
+        costs.append(home.get_total_cost())
+    assert np.isclose(result.objective, sum(costs))
+    decomposed = optimizer.solve_decomposed(max_workers=1)
+    assert decomposed.status == 'Optimal' and decomposed.iterations == 1
+    assert np.isclose(decomposed.objective, sum(costs))
+
+
+def test_feeder_limit_and_peak_charge():
+    homes = {seed: make_home(seed) for seed in range(4)}
+    optimizer = MultiHomeOptimizer(24, homes, feeder_limit=15, peak_price=20, current_peak=8)
+    result = optimizer.solve()
+    assert result.status == 'Optimal'
+    load = optimizer.get_feeder_load()
+    assert load.max() <= 15 + 1e-6
+    series = optimizer.get_time_series()
+    home_costs = sum(prices @ series[home]['mains']['import'] for home in homes)
+    assert home_costs < result.objective
+
+    for max_workers in [1, 2]:
+        decomposed = optimizer.solve_decomposed(max_workers=max_workers)
+        assert decomposed.status == 'Optimal'
+        assert decomposed.max_violation == 0
+        assert decomposed.lower_bound <= decomposed.objective + 1e-6
+        np.testing.assert_allclose(decomposed.objective, result.objective, rtol=1e-4)
+        assert optimizer.get_feeder_load().max() <= 15 + 1e-6
+        assert np.isclose(optimizer.get_total_cost(), decomposed.objective)
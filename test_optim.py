@@ -1,5 +1,6 @@
-from optim import EnergyOptimizer
+from optim import EnergyOptimizer, SolverConfig, aggregate_to_steps, solve_matrix_model
 import numpy as np
+import pytest
 
 
 
@@ -127,6 +128,443 @@ def test_solar():
     check_bounds(series['solar']['production'], 0, hourly_solar_production)
 
 
+def test_scipy_backend():
+    # The sparse matrix model solved directly by scipy/HiGHS must agree with the pulp backend.
+    pytest.importorskip("scipy")
+    hourly_prices = [15, 18, 19, 10, 10, 10, 10, 10, 10, 10, 10, 12, 14, 15, 15, 13, 14, 12, 15, 14, 13, 11, 10, 13]
+    hourly_consumption = [1, 1, 2, 1, 1, 1, 2, 1, 2, 5, 1, 2, 3, 14, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
+    hourly_heating_demand= [1.2, 2, 1, 1.5, 1.7, 1.8, 1.3, 1.7, 2.1, 3.3, 1.2, 2.7, 1.2, 2.3, 1.2, 1.1, 1.3, 1.2, 1.7, 2.1, 2.5, 2.7, 2.8, 2.9]
+    min_ev_charge_by_hour= [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,47,0,0,0,0,0,0]
+
+    costs = {}
+    for backend in ['pulp', 'scipy']:
+        optimizer = EnergyOptimizer(len(hourly_prices), backend=backend)
+        optimizer.add_mains_electricity_supply(name='mains', max_import_power=10, import_hourly_prices=hourly_prices,
+            max_export_power=3, export_hourly_prices=[5] * len(hourly_prices))
+        optimizer.add_battery(name='battery', capacity=15, initial_soc=10, efficiency=0.95, max_charge_power=5,
+            max_discharge_power=5, cost_of_cycle_kwh=1, final_energy_value_per_kwh=12)
+        optimizer.add_fixed_consumption(name='consumption', hourly_consumption=hourly_consumption)
+        optimizer.add_heating_consumption(name='heatpump', max_heat_power=3.0, hourly_demand=hourly_heating_demand,
+            tol_cumul_min=-2, tol_cumul_max=2, final_energy_value_per_kwh=12)
+        optimizer.add_flexible_consumption(name='ev_charging', max_power=5.0, min_cumulative_consuption=min_ev_charge_by_hour)
+        optimizer.solve()
+        costs[backend] = optimizer.get_total_cost()
+
+        series = optimizer.get_time_series()
+        balance = (series['mains']['import'] + series['mains']['export'] - series['battery']['charge_rate']
+            - series['battery']['discharge_rate'] * 0.95 - series['heatpump']['consumption'] - series['ev_charging']['consumption'])
+        np.testing.assert_allclose(balance, hourly_consumption, atol=1e-4)
+        assert np.cumsum(series['ev_charging']['consumption'])[17] >= 47 - 1e-4
+
+    np.testing.assert_allclose(costs['scipy'], costs['pulp'], rtol=1e-6)
+
+
+def build_rolling_example(backend, initial_soc, prices, consumption, solar, heating_demand):
+    optimizer = EnergyOptimizer(len(prices), backend=backend)
+    optimizer.add_mains_electricity_supply(name='mains', max_import_power=10, import_hourly_prices=prices,
+        max_export_power=5, export_hourly_prices=[5] * len(prices))
+    optimizer.add_battery(name='battery', capacity=15, initial_soc=initial_soc, efficiency=0.95, max_charge_power=5,
+        max_discharge_power=5, cost_of_cycle_kwh=1, final_energy_value_per_kwh=12)
+    optimizer.add_fixed_consumption(name='consumption', hourly_consumption=consumption)
+    optimizer.add_solar_production(name='solar', estimated_hourly_production=solar)
+    optimizer.add_heating_consumption(name='heatpump', max_heat_power=3.0, hourly_demand=heating_demand,
+        tol_cumul_min=-2, tol_cumul_max=2, final_energy_value_per_kwh=12)
+    return optimizer
+
+
+def test_rolling_update():
+    # Updating data of a solved model must give the same plan cost as building the model from scratch.
+    prices = [15, 18, 19, 10, 10, 10, 10, 10, 10, 10, 10, 12, 14, 15, 15, 13, 14, 12, 15, 14, 13, 11, 10, 13]
+    consumption = [1, 1, 2, 1, 1, 1, 2, 1, 2, 5, 1, 2, 3, 4, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
+    solar = [0, 0, 0, 1, 4, 8, 8, 9, 9, 8, 6, 4, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+    heating_demand = [1.2, 2, 1, 1.5, 1.7, 1.8, 1.3, 1.7, 2.1, 3.3, 1.2, 2.7, 1.2, 2.3, 1.2, 1.1, 1.3, 1.2, 1.7, 2.1, 2.5, 2.7, 2.8, 2.9]
+    new_prices = np.roll(prices, 3)
+    new_consumption = np.roll(consumption, 5)
+    new_solar = np.array(solar) * 0.5
+    new_heating_demand = np.roll(heating_demand, 2)
+
+    for backend in ['pulp', 'scipy']:
+        if backend == 'scipy':
+            pytest.importorskip("scipy")
+        optimizer = build_rolling_example(backend, 10, prices, consumption, solar, heating_demand)
+        optimizer.solve()
+        optimizer.update_initial_soc('battery', 4)
+        optimizer.update_prices('mains', import_hourly_prices=new_prices)
+        optimizer.update_forecast('consumption', new_consumption)
+        optimizer.update_forecast('solar', new_solar)
+        optimizer.update_forecast('heatpump', new_heating_demand)
+        optimizer.solve(warm_start=True)
+
+        fresh = build_rolling_example(backend, 4, new_prices, new_consumption, new_solar, new_heating_demand)
+        fresh.solve()
+        np.testing.assert_allclose(optimizer.get_total_cost(), fresh.get_total_cost(), rtol=1e-6)
+        np.testing.assert_allclose(optimizer.get_time_series()['consumption']['consumption'], new_consumption)
+        assert optimizer.get_time_series()['battery']['soc'][0] <= 4 + 5 + 1e-6
+
+
+def test_returned_variables():
+    # add_* methods return pulp variables by hour with the pulp backend and column indices with the scipy backend.
+    for backend in ['pulp', 'scipy']:
+        optimizer = EnergyOptimizer(4, backend=backend)
+        optimizer.add_mains_electricity_supply(name='mains', max_import_power=10, import_hourly_prices=[1, 1, 10, 10])
+        optimizer.add_fixed_consumption(name='consumption', hourly_consumption=[1] * 4)
+        soc, charge_rate, discharge_rate = optimizer.add_battery(name='battery', capacity=10, initial_soc=0, efficiency=0.95,
+            max_charge_power=5, max_discharge_power=5, cost_of_cycle_kwh=0, final_energy_value_per_kwh=0)
+        optimizer.solve()
+        series = optimizer.get_time_series()['battery']
+        if backend == 'pulp':
+            assert len(soc) == 4 and list(soc) == [0, 1, 2, 3]
+            assert soc[0].name == 'battery_soc_0'
+            np.testing.assert_allclose([soc[hour].varValue for hour in soc], series['soc'], atol=1e-5)
+        else:
+            np.testing.assert_array_equal(soc, optimizer.vars['battery']['soc'])
+            np.testing.assert_array_equal(np.diff(charge_rate), 1)
+
+
+def test_matrix_model():
+    # Solving the matrix model and setting its solution gives the plan of solve().
+    pytest.importorskip("scipy")
+    optimizer = build_rolling_example('scipy', 10, [15, 18, 19, 10] * 6, [1, 2] * 12, [0, 3] * 12, [1.5] * 24)
+    optimizer.solve()
+    model = optimizer.get_matrix_model()
+    assert model.n_vars == optimizer.n_vars and model.n_rows == optimizer.n_rows
+    solution, stats = solve_matrix_model(model)
+    assert stats.status == 'Optimal' and stats.n_vars == optimizer.n_vars
+    other = build_rolling_example('scipy', 10, [15, 18, 19, 10] * 6, [1, 2] * 12, [0, 3] * 12, [1.5] * 24)
+    other.set_solution(solution)
+    np.testing.assert_allclose(other.get_total_cost(), optimizer.get_total_cost(), rtol=1e-6)
+    np.testing.assert_allclose(solution[other.get_columns()['battery']['soc']], other.get_time_series()['battery']['soc'], rtol=1e-6)
+
+
+def test_lp_fast_path():
+    # With export prices strictly below import prices the supply is a pure LP and matches the MILP plan.
+    prices = [15, 18, 19, 10, 10, 10, 10, 10, 15, 15, 10, 12, 14, 15, 15, 13, 14, 12, 15, 14, 13, 11, 10, 13]
+    consumption = [1, 1, 2, 1, 1, 1, 2, 1, 2, 5, 1, 2, 3, 4, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
+    solar = [0, 0, 0, 1, 4, 8, 8, 9, 9, 8, 6, 4, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+    costs = {}
+    for force_direction in [False, True]:
+        optimizer = EnergyOptimizer(len(prices))
+        optimizer.add_mains_electricity_supply(name='mains', max_import_power=10, import_hourly_prices=prices,
+            max_export_power=9, export_hourly_prices=[9] * len(prices), force_direction=force_direction)
+        optimizer.add_fixed_consumption(name='consumption', hourly_consumption=consumption)
+        optimizer.add_solar_production(name='solar', estimated_hourly_production=solar)
+        optimizer.add_battery(name='battery', capacity=15, initial_soc=10, efficiency=0.95, max_charge_power=5,
+            max_discharge_power=10, cost_of_cycle_kwh=1, final_energy_value_per_kwh=12)
+        optimizer.solve()
+        costs[force_direction] = optimizer.get_total_cost()
+        series = optimizer.get_time_series()
+        check_at_most_one_nonzero(series['mains']['import'], series['mains']['export'], atol=1e-6)
+        if force_direction:
+            assert optimizer.supply_modes['mains'] == 'MILP'
+            assert optimizer.model_type() == 'MILP'
+        else:
+            assert optimizer.supply_modes['mains'] == 'LP'
+            assert optimizer.model_type() == 'LP'
+            assert 'direction' not in series['mains']
+    np.testing.assert_allclose(costs[False], costs[True], rtol=1e-6)
+
+    optimizer = EnergyOptimizer(len(prices))
+    optimizer.add_mains_electricity_supply(name='mains', max_import_power=10, import_hourly_prices=prices, max_export_power=0)
+    assert optimizer.supply_modes['mains'] == 'LP'
+    optimizer = EnergyOptimizer(len(prices))
+    optimizer.add_mains_electricity_supply(name='mains', max_import_power=10, import_hourly_prices=prices,
+        max_export_power=9, export_hourly_prices=prices)
+    assert optimizer.supply_modes['mains'] == 'MILP'
+
+    # Updating the prices of a solved LP supply across the import prices adds the direction series in place.
+    for backend in ['pulp', 'scipy']:
+        optimizer = EnergyOptimizer(len(prices), backend=backend)
+        optimizer.add_mains_electricity_supply(name='mains', max_import_power=10, import_hourly_prices=prices,
+            max_export_power=9, export_hourly_prices=[9] * len(prices))
+        optimizer.add_fixed_consumption(name='consumption', hourly_consumption=consumption)
+        optimizer.add_solar_production(name='solar', estimated_hourly_production=solar)
+        optimizer.solve()
+        assert optimizer.supply_modes['mains'] == 'LP'
+        optimizer.update_prices('mains', export_hourly_prices=[16] * len(prices))
+        assert optimizer.supply_modes['mains'] == 'MILP'
+        assert optimizer.solve().status == 'Optimal'
+        series = optimizer.get_time_series()
+        check_at_most_one_nonzero(series['mains']['import'], series['mains']['export'], atol=1e-6)
+        rebuilt = EnergyOptimizer.from_devices(len(prices), optimizer.get_devices(), backend=backend)
+        rebuilt.solve()
+        assert rebuilt.supply_modes['mains'] == 'MILP'
+        np.testing.assert_allclose(optimizer.get_total_cost(), rebuilt.get_total_cost(), rtol=1e-6)
+
+
+def test_solve_stats(capfd):
+    # Solving is silent by default and reports model size and timings.
+    optimizer = EnergyOptimizer(24)
+    optimizer.add_mains_electricity_supply(name='mains', max_import_power=10, import_hourly_prices=[10] * 12 + [20] * 12)
+    optimizer.add_battery(name='battery', capacity=15, initial_soc=10, efficiency=0.95, max_charge_power=5,
+        max_discharge_power=5, cost_of_cycle_kwh=1, final_energy_value_per_kwh=12)
+    optimizer.add_fixed_consumption(name='consumption', hourly_consumption=[1] * 24)
+    capfd.readouterr()
+    optimizer.solve()
+    out, _ = capfd.readouterr()
+    assert out == ''
+    stats = optimizer.stats
+    assert stats.status == 'Optimal'
+    assert stats.model_type == 'LP'
+    assert stats.n_vars == optimizer.n_vars == 24 * 6
+    assert stats.n_integer_vars == 0
+    # Energy balance, conservation of charge and the charge/discharge rate coupling.
+    assert stats.n_constraints == 24 * 3
+    assert set(stats.build_time) == {'mains', 'battery', 'consumption'}
+    assert stats.solve_time > 0
+
+
+def test_cumulative_model_size():
+    # Cumulative devices track their running sums as state series, so model size grows linearly with the horizon.
+    nonzeros = {}
+    for n in [24, 96]:
+        optimizer = EnergyOptimizer(n)
+        optimizer.add_mains_electricity_supply(name='mains', max_import_power=20, import_hourly_prices=[10, 20] * (n // 2))
+        optimizer.add_flexible_consumption(name='ev_charging', max_power=5.0, min_cumulative_consuption=[0] * (n - 1) + [30])
+        optimizer.add_heating_consumption(name='heatpump', max_heat_power=3.0, hourly_demand=[1.5] * n,
+            tol_cumul_min=-2, tol_cumul_max=2, final_energy_value_per_kwh=12)
+        optimizer.solve()
+        nonzeros[n] = optimizer.stats.n_nonzeros
+        series = optimizer.get_time_series()
+        for device in ['ev_charging', 'heatpump']:
+            np.testing.assert_allclose(series[device]['cumul_consumption'], np.cumsum(series[device]['consumption']), atol=1e-4)
+        assert series['ev_charging']['cumul_consumption'][-1] >= 30 - 1e-6
+        check_bounds(series['heatpump']['cumul_consumption'] - 1.5 * np.arange(1, n + 1), -2, 2, atol=1e-4)
+    assert nonzeros[96] <= 4.1 * nonzeros[24]
+
+
+def test_solver_config():
+    # Solver limits are passed through, and an infeasible re-solve can fall back to the last plan.
+    optimizer = EnergyOptimizer(24)
+    optimizer.add_mains_electricity_supply(name='mains', max_import_power=10, import_hourly_prices=[10] * 12 + [20] * 12)
+    optimizer.add_battery(name='battery', capacity=15, initial_soc=10, efficiency=0.95, max_charge_power=5,
+        max_discharge_power=5, cost_of_cycle_kwh=1, final_energy_value_per_kwh=12)
+    optimizer.add_fixed_consumption(name='consumption', hourly_consumption=[1] * 24)
+    result = optimizer.solve(solver=SolverConfig(name='CBC', time_limit=10, mip_gap=0.01, threads=1))
+    assert result.status == 'Optimal'
+    assert result.has_solution and not result.used_fallback
+    np.testing.assert_allclose(result.objective, optimizer.get_total_cost())
+    assert optimizer.stats.solver == 'PULP_CBC_CMD'
+    plan = optimizer.get_time_series()
+
+    # Consumption above the import limit and the battery power can not be satisfied.
+    optimizer.update_forecast('consumption', [30] * 24)
+    result = optimizer.solve()
+    assert not result.has_solution
+    assert np.isnan(result.objective)
+    assert np.all(np.isnan(optimizer.get_time_series()['battery']['soc']))
+    result = optimizer.solve(solver=SolverConfig(fallback_to_last_plan=True))
+    assert result.status == 'Infeasible'
+    assert result.used_fallback
+    np.testing.assert_allclose(optimizer.get_time_series()['battery']['soc'], plan['battery']['soc'])
+
+    with pytest.raises(ValueError):
+        optimizer.solve(solver='NO_SUCH_SOLVER')
+
+    # A plan of the model before new devices were added does not fit it and is not restored.
+    optimizer = EnergyOptimizer(24)
+    optimizer.add_mains_electricity_supply(name='mains', max_import_power=10, import_hourly_prices=[10] * 24)
+    optimizer.add_fixed_consumption(name='consumption', hourly_consumption=[1] * 24)
+    assert optimizer.solve().has_solution
+    optimizer.add_fixed_consumption(name='heater', hourly_consumption=[30] * 24)
+    result = optimizer.solve(solver=SolverConfig(fallback_to_last_plan=True))
+    assert not result.has_solution and not result.used_fallback
+    assert np.isnan(result.objective)
+    assert optimizer.get_time_series()['heater']['consumption'].shape == (24,)
+
+
+def test_bulk_results():
+    # Structured array, DataFrame and hourly costs all come from the same solution vector.
+    prices = [15, 18, 19, 10, 10, 10, 10, 10, 15, 15, 10, 12, 14, 15, 15, 13, 14, 12, 15, 14, 13, 11, 10, 13]
+    optimizer = build_rolling_example('pulp', 10, prices, [1] * 24, [0] * 6 + [3] * 12 + [0] * 6, [1.5] * 24)
+    optimizer.solve()
+    series = optimizer.get_time_series()
+
+    array = optimizer.get_solution_array()
+    assert array.shape == (24,)
+    for device_name, device_series in series.items():
+        for var_name, values in device_series.items():
+            np.testing.assert_array_equal(array[device_name][var_name], values)
+
+    costs = optimizer.get_hourly_costs()
+    np.testing.assert_allclose(costs['mains'], series['mains']['import'] * prices + series['mains']['export'] * 5, rtol=1e-5, atol=1e-5)
+    # Only the constant part of the heat pump cost is missing from the hourly attribution.
+    np.testing.assert_allclose(sum(c.sum() for c in costs.values()) + 1.5 * 24 * 12, optimizer.get_total_cost(), rtol=1e-9)
+
+    pytest.importorskip("pandas")
+    titles = ['%02d:00' % hour for hour in range(24)]
+    df = optimizer.get_dataframe(hour_titles=titles)
+    assert list(df.index) == titles
+    np.testing.assert_allclose(df['battery', 'soc'].to_numpy(), series['battery']['soc'], rtol=1e-6)
+
+
+def test_variable_time_steps():
+    # A model with data constant within each hour plans at the same cost with 15 minute or mixed time steps.
+    prices = np.array([15, 18, 19, 10, 10, 10, 10, 10, 15, 15, 10, 12, 14, 15, 15, 13, 14, 12, 15, 14, 13, 11, 10, 13])
+    consumption = np.array([1, 1, 2, 1, 1, 1, 2, 1, 2, 5, 1, 2, 3, 4, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1])
+    solar = np.array([0, 0, 0, 1, 4, 8, 8, 9, 9, 8, 6, 4, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0])
+    heating_demand = np.array([1.2, 2, 1, 1.5, 1.7, 1.8, 1.3, 1.7, 2.1, 3.3, 1.2, 2.7, 1.2, 2.3, 1.2, 1.1, 1.3, 1.2, 1.7, 2.1, 2.5, 2.7, 2.8, 2.9])
+
+    def solve(step_hours, repeats):
+        n = len(step_hours)
+        # Cumulative EV demand applies from the end of hour 17 on.
+        step_ends = np.cumsum(step_hours)
+        min_cumulative = np.where(step_ends >= 18 - 1e-9, 20.0, 0.0) * (step_ends <= 18 + 1e-9)
+        optimizer = EnergyOptimizer(n, step_hours=step_hours)
+        optimizer.add_mains_electricity_supply(name='mains', max_import_power=10, import_hourly_prices=np.repeat(prices, repeats),
+            max_export_power=5, export_hourly_prices=[5] * n)
+        optimizer.add_fixed_consumption(name='consumption', hourly_consumption=np.repeat(consumption, repeats))
+        optimizer.add_solar_production(name='solar', estimated_hourly_production=np.repeat(solar, repeats))
+        optimizer.add_battery(name='battery', capacity=15, initial_soc=10, efficiency=0.95, max_charge_power=5,
+            max_discharge_power=5, cost_of_cycle_kwh=1, final_energy_value_per_kwh=12)
+        optimizer.add_heating_consumption(name='heatpump', max_heat_power=3.0, hourly_demand=np.repeat(heating_demand, repeats),
+            tol_cumul_min=-2, tol_cumul_max=2, final_energy_value_per_kwh=12)
+        optimizer.add_flexible_consumption(name='ev_charging', max_power=7.0, min_cumulative_consuption=min_cumulative)
+        optimizer.solve()
+        return optimizer
+
+    hourly = solve(np.ones(24), 1)
+    quarter = solve(np.full(96, 0.25), 4)
+    # 15 minute steps for the first 6 hours, hourly after that.
+    repeats = np.array([4] * 6 + [1] * 18)
+    mixed = solve(np.repeat(1.0 / repeats, repeats), repeats)
+    np.testing.assert_allclose(quarter.get_total_cost(), hourly.get_total_cost(), rtol=1e-6)
+    np.testing.assert_allclose(mixed.get_total_cost(), hourly.get_total_cost(), rtol=1e-6)
+
+    series = mixed.get_time_series()
+    step_hours = mixed.step_hours
+    soc = series['battery']['soc']
+    np.testing.assert_allclose(np.diff(soc, prepend=10),
+        (series['battery']['charge_rate'] + series['battery']['discharge_rate']) * step_hours, atol=1e-5)
+    np.testing.assert_allclose(series['ev_charging']['cumul_consumption'],
+        np.cumsum(series['ev_charging']['consumption'] * step_hours), atol=1e-4)
+
+    np.testing.assert_allclose(aggregate_to_steps(np.arange(8.0), [0.25, 0.25, 0.5, 1.0]), [0, 1, 2.5, 5.5])
+
+
+def test_battery_losses(caplog):
+    def build(force_exclusive=False, prices=[-20, -20, 10, 10], **kwargs):
+        optimizer = EnergyOptimizer(4)
+        optimizer.add_mains_electricity_supply(name='mains', max_import_power=10, import_hourly_prices=prices)
+        optimizer.add_fixed_consumption(name='consumption', hourly_consumption=[1] * 4)
+        optimizer.add_battery(name='battery', capacity=10, initial_soc=10, efficiency=None, charge_efficiency=0.95,
+            discharge_efficiency=0.9, max_charge_power=3, max_discharge_power=3, cost_of_cycle_kwh=0,
+            final_energy_value_per_kwh=10, force_exclusive=force_exclusive, **kwargs)
+        optimizer.solve()
+        return optimizer
+
+    # At negative prices burning energy by charging and discharging at once would pay, so the binary series is added.
+    for force_exclusive in [False, True]:
+        optimizer = build(force_exclusive=force_exclusive)
+        assert optimizer.battery_modes['battery'] == 'MILP'
+        series = optimizer.get_time_series()['battery']
+        check_at_most_one_nonzero(series['charge_rate'], series['discharge_rate'], atol=1e-6)
+        assert caplog.text == ''
+        soc = np.concatenate([[10], series['soc']])
+        np.testing.assert_allclose(np.diff(soc), 0.95 * series['charge_rate'] + series['discharge_rate'], atol=1e-5)
+
+    # Positive prices keep the pure LP, which does not charge and discharge at once.
+    optimizer = build(prices=[1, 1, 10, 10])
+    assert optimizer.battery_modes['battery'] == 'LP' and optimizer.model_type() == 'LP'
+    series = optimizer.get_time_series()['battery']
+    check_at_most_one_nonzero(series['charge_rate'], series['discharge_rate'], atol=1e-6)
+    assert caplog.text == ''
+    # Negative prices set later add the binary series in place, e.g. in a rolling horizon.
+    optimizer.update_prices('mains', [-20, -20, 10, 10])
+    assert optimizer.battery_modes['battery'] == 'MILP'
+    optimizer.solve()
+    np.testing.assert_allclose(optimizer.get_total_cost(), build().get_total_cost(), atol=1e-5)
+    # So does a supply with negative prices added after the battery.
+    optimizer = build(prices=[1, 1, 10, 10])
+    optimizer.add_mains_electricity_supply(name='generator', max_import_power=1, import_hourly_prices=[-5, 10, 10, 10])
+    assert optimizer.battery_modes['battery'] == 'MILP'
+
+    # Negative export prices: energy of a forced discharge would rather be burnt than exported.
+    for backend in ['pulp', 'scipy']:
+        optimizer = EnergyOptimizer(4, backend=backend)
+        optimizer.add_mains_electricity_supply(name='mains', max_import_power=10, import_hourly_prices=[10] * 4,
+            max_export_power=3, export_hourly_prices=[-20] * 4)
+        optimizer.add_fixed_consumption(name='consumption', hourly_consumption=[1] * 4)
+        optimizer.add_solar_production(name='solar', estimated_hourly_production=[6] * 4)
+        optimizer.add_battery(name='battery', capacity=10, initial_soc=10, efficiency=0.5, max_charge_power=5,
+            max_discharge_power=5, cost_of_cycle_kwh=0, final_energy_value_per_kwh=10, max_soc=[5, 10, 10, 10])
+        assert optimizer.battery_modes['battery'] == 'MILP'
+        optimizer.solve()
+        series = optimizer.get_time_series()['battery']
+        check_at_most_one_nonzero(series['charge_rate'], series['discharge_rate'], atol=1e-6)
+        assert caplog.text == ''
+
+    # Self-discharge and auxiliary consumption.
+    optimizer = build(force_exclusive=True, standby_loss=0.01, aux_power=0.5)
+    series = optimizer.get_time_series()
+    soc = np.concatenate([[10], series['battery']['soc']])
+    np.testing.assert_allclose(soc[1:] - 0.99 * soc[:-1],
+        0.95 * series['battery']['charge_rate'] + series['battery']['discharge_rate'], atol=1e-5)
+    np.testing.assert_allclose(series['mains']['import'], 1.5 + series['battery']['charge_rate']
+        + 0.9 * series['battery']['discharge_rate'], atol=1e-5)
+    optimizer.update_initial_soc('battery', 5)
+    optimizer.solve()
+    series = optimizer.get_time_series()['battery']
+    assert np.isclose(series['soc'][0] - 0.95 * series['charge_rate'][0] - series['discharge_rate'][0], 0.99 * 5, atol=1e-5)
+
+
+def test_sensitivity():
+    pytest.importorskip("scipy")
+    prices = np.array([15, 18, 19, 10, 10, 10, 10, 10, 15, 15, 10, 12, 14, 15, 15, 13, 14, 12, 15, 14, 13, 11, 10, 13])
+    consumption = np.array([1, 1, 2, 1, 1, 1, 2, 1, 2, 5, 1, 2, 3, 4, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1])
+
+    def build(prices=prices, consumption=consumption, initial_soc=5, capacity=10, force_direction=False):
+        optimizer = EnergyOptimizer(24)
+        optimizer.add_mains_electricity_supply(name='mains', max_import_power=10, import_hourly_prices=prices,
+            max_export_power=2, export_hourly_prices=[5] * 24, force_direction=force_direction)
+        optimizer.add_fixed_consumption(name='consumption', hourly_consumption=consumption)
+        optimizer.add_battery(name='battery', capacity=capacity, initial_soc=initial_soc, efficiency=0.95, max_charge_power=3,
+            max_discharge_power=3, cost_of_cycle_kwh=1, final_energy_value_per_kwh=12)
+        optimizer.solve()
+        return optimizer
+
+    for force_direction in [False, True]:
+        optimizer = build(force_direction=force_direction)
+        cost = optimizer.get_total_cost()
+        sensitivity = optimizer.get_sensitivity()
+        assert sensitivity.energy_value.shape == (24,)
+        assert np.all(sensitivity.soc_lower['battery'] >= -1e-9) and np.all(sensitivity.soc_upper['battery'] <= 1e-9)
+        assert sensitivity.reduced_costs['battery']['soc'].shape == (24,)
+        assert sensitivity.capacity_value['battery'] == pytest.approx(-optimizer.what_if({('battery', 'capacity'): [1.0]})[0])
+
+        # Small changes priced without solving again match solving the changed model.
+        delta = 0.1 * np.eye(24)[[9, 18]]
+        estimates = optimizer.what_if({('consumption', 'hourly_consumption'): delta})
+        for hour, estimate in zip([9, 18], estimates):
+            assert estimate == pytest.approx(sensitivity.energy_value[hour] * 0.1, abs=1e-6)
+            assert estimate == pytest.approx(build(consumption=consumption + 0.1 * np.eye(24)[hour]).get_total_cost() - cost, abs=1e-5)
+        estimates = optimizer.what_if({('mains', 'import_hourly_prices'): delta})
+        series = optimizer.get_time_series()
+        np.testing.assert_allclose(estimates, 0.1 * series['mains']['import'][[9, 18]], atol=1e-6)
+        estimate = optimizer.what_if({('battery', 'initial_soc'): [0.1], ('battery', 'capacity'): [0.1]})[0]
+        assert estimate == pytest.approx(build(initial_soc=5.1, capacity=10.1).get_total_cost() - cost, abs=1e-5)
+    with pytest.raises(ValueError):
+        optimizer.what_if({('battery', 'efficiency'): [0.1]})
+
+    # Where max_soc equals capacity, a larger capacity does not move the soc bound; max_soc gets the dual.
+    def build_limited(capacity=10, max_soc=np.array([10.0] * 12 + [20.0] * 12)):
+        optimizer = EnergyOptimizer(24, backend='scipy')
+        optimizer.add_mains_electricity_supply(name='mains', max_import_power=10, import_hourly_prices=[1] * 12 + [30] * 12)
+        optimizer.add_fixed_consumption(name='consumption', hourly_consumption=[1] * 24)
+        optimizer.add_battery(name='battery', capacity=capacity, initial_soc=0, efficiency=0.95, max_charge_power=5,
+            max_discharge_power=5, cost_of_cycle_kwh=1, final_energy_value_per_kwh=5, max_soc=max_soc)
+        optimizer.solve()
+        return optimizer
+
+    optimizer = build_limited()
+    cost = optimizer.get_total_cost()
+    assert optimizer.get_sensitivity().capacity_value['battery'] == pytest.approx(0)
+    assert optimizer.what_if({('battery', 'capacity'): [1.0]})[0] == pytest.approx(build_limited(capacity=11).get_total_cost() - cost)
+    delta = -0.1 * np.eye(24)[11]
+    estimate = optimizer.what_if({('battery', 'max_soc'): [delta]})[0]
+    assert estimate > 0
+    assert estimate == pytest.approx(build_limited(max_soc=np.array([10.0] * 12 + [20.0] * 12) + delta).get_total_cost() - cost, abs=1e-5)
+
+
 def simple_heatpump_example():
     # Example usage:
     hourly_prices = [15, 18, 19, 10, 10, 10, 10, 10, 10, 10, 10, 12, 14, 15, 15, 13, 14, 12, 15, 14, 13, 11, 10, 13]
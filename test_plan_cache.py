@@ -0,0 +1,83 @@
+from plan_cache import PlanCache
+import numpy as np
+import pytest
+
+
+prices = [15, 18, 19, 10, 10, 10, 10, 10, 15, 15, 10, 12, 14, 15, 15, 13, 14, 12, 15, 14, 13, 11, 10, 13]
+
+
+def make_devices(initial_soc, prices=prices):
+    return [
+        ('add_mains_electricity_supply', dict(name='mains', max_import_power=10, import_hourly_prices=prices)),
+        ('add_fixed_consumption', dict(name='consumption', hourly_consumption=[1] * 24)),
+        ('add_battery', dict(name='battery', capacity=15, initial_soc=initial_soc, efficiency=0.95, max_charge_power=5,
+            max_discharge_power=5, cost_of_cycle_kwh=1, final_energy_value_per_kwh=12)),
+    ]
+
+
+class FakeClock():
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_quantized_hits_and_lru():
+    cache = PlanCache(max_entries=2, soc_quantum=0.5, price_quantum=0.1)
+    plan = cache.get_plan(24, make_devices(10.1))
+    assert (cache.hits, cache.misses) == (0, 1)
+    # Same inputs within sensor and price precision.
+    assert cache.get_plan(24, make_devices(9.9, np.array(prices) + 0.01)) is plan
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert plan['battery']['soc'][0] <= 10 + 5 + 1e-6
+    with pytest.raises(ValueError):
+        plan['battery']['soc'][0] = 0
+
+    cache.get_plan(24, make_devices(5))
+    cache.get_plan(24, make_devices(10))
+    cache.get_plan(24, make_devices(0))
+    assert cache.evictions == 1
+    # 5 was the least recently used plan.
+    cache.get_plan(24, make_devices(10))
+    assert cache.hits == 3
+    cache.get_plan(24, make_devices(5))
+    assert cache.misses == 4
+
+
+def test_ttl_and_disk_store(tmp_path):
+    clock = FakeClock()
+    cache = PlanCache(ttl_seconds=60, path=str(tmp_path), clock=clock)
+    plan = cache.get_plan(24, make_devices(10))
+    assert len(list(tmp_path.glob('*.npz'))) == 1
+
+    # A new cache, e.g. after a restart, serves the stored plan.
+    restarted = PlanCache(ttl_seconds=60, path=str(tmp_path), clock=clock)
+    stored = restarted.get_plan(24, make_devices(10))
+    assert (restarted.hits, restarted.disk_hits, restarted.misses) == (1, 1, 0)
+    for device_name, device_series in plan.items():
+        for var_name, values in device_series.items():
+            np.testing.assert_array_equal(stored[device_name][var_name], values)
+
+    clock.now += 61
+    cache.get_plan(24, make_devices(10))
+    assert cache.expirations >= 1
+    assert cache.misses == 2
+
+
+def test_concurrent_disk_writes(tmp_path):
+    # Threads storing the same plan at once each write their own temporary file.
+    import threading
+    cache = PlanCache(path=str(tmp_path))
+    plan = cache.get_plan(24, make_devices(5))
+    key = cache.key(24, make_devices(5))
+    threads = [threading.Thread(target=cache._save, args=(key, 1000.0 + i, plan)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(p.name for p in tmp_path.iterdir()) == [key + '.npz']
+    cache.clear()
+    np.testing.assert_array_equal(cache.get_plan(24, make_devices(5))['battery']['soc'], plan['battery']['soc'])
+    assert cache.disk_hits == 1
@@ -0,0 +1,47 @@
+from service import DispatchService, PricePublication, Telemetry, fake_feed
+from test_plan_cache import make_devices
+import asyncio
+import numpy as np
+
+
+def test_stale_plans_are_dropped():
+    service = DispatchService({'a': make_devices(0)}, 24)
+    updates = [Telemetry('a', {'battery': {'initial_soc': soc}}) for soc in [1, 2, 3, 4, 15]]
+
+    async def main():
+        queue = service.subscribe()
+        await service.run(telemetry=fake_feed(updates))
+        return queue
+
+    queue = asyncio.run(main())
+    plan = service.plans['a']
+    # Only the plan for the latest telemetry is published.
+    assert plan.version == 5
+    assert service.dropped >= 1
+    assert queue.qsize() == 1 and queue.get_nowait() is plan
+    battery = plan.series['battery']
+    assert np.allclose(plan.commands, battery['charge_rate'] + battery['discharge_rate'])
+    # Full battery discharges into the expensive first hour.
+    assert service.current_command('a') < 0
+    assert plan.command_names()[0] == 'Discharge'
+    assert set(plan.command_names()) <= {'Charge', 'Idle', 'Discharge'}
+
+
+def test_prices_replan_all_homes():
+    homes = {'a': make_devices(0), 'b': make_devices(10)}
+    service = DispatchService(homes, 24, max_concurrency=1)
+    hour_titles = ['%02d:00' % hour for hour in range(24)]
+    flat = PricePublication(prices=[10] * 24, hour_titles=hour_titles)
+    cheap_first = PricePublication(prices=[1] + [20] * 23, hour_titles=hour_titles)
+    telemetry = [Telemetry('b', {'consumption': {'hourly_consumption': [2] * 24}})]
+
+    asyncio.run(service.run(telemetry=fake_feed(telemetry, 0.01), prices=fake_feed([flat, cheap_first])))
+    assert set(service.plans) == {'a', 'b'}
+    for home in homes:
+        plan = service.plans[home]
+        assert plan.hour_titles == hour_titles
+        assert plan.version == (2 if home == 'a' else 3)
+    # Empty battery charges at the cheap first hour.
+    assert service.current_command('a') > 0
+    assert service.plans['a'].command_names()[0] == 'Charge'
+    assert service.current_command('missing') is None
@@ -0,0 +1,79 @@
+from optim import EnergyOptimizer
+from stochastic import ScenarioOptimizer
+import time
+import numpy as np
+
+
+prices = np.array([15, 18, 19, 10, 10, 10, 10, 10, 15, 15, 10, 12, 14, 15, 15, 13, 14, 12, 15, 14, 13, 11, 10, 13], dtype=float)
+
+
+def make_devices(n_hours=24, prices=prices):
+    return [
+        ('add_mains_electricity_supply', dict(name='mains', max_import_power=10, import_hourly_prices=prices,
+            max_export_power=5, export_hourly_prices=prices * 0.5)),
+        ('add_fixed_consumption', dict(name='consumption', hourly_consumption=[1] * n_hours)),
+        ('add_solar_production', dict(name='solar', estimated_hourly_production=[0] * n_hours)),
+        ('add_battery', dict(name='battery', capacity=15, initial_soc=5, efficiency=0.95, max_charge_power=5,
+            max_discharge_power=5, cost_of_cycle_kwh=1, final_energy_value_per_kwh=12)),
+    ]
+
+
+def solar_ensemble(n_scenarios, n_hours, seed=0):
+    rng = np.random.default_rng(seed)
+    hour_of_day = np.arange(n_hours) % 24
+    profile = np.clip(6 * np.sin((hour_of_day - 6) / 14 * np.pi), 0, None)
+    return profile * rng.uniform(0.1, 1.0, (n_scenarios, 1))
+
+
+def test_single_scenario_matches_deterministic():
+    solar = solar_ensemble(1, 24)
+    optimizer = ScenarioOptimizer(24, make_devices(), {'solar': solar})
+    result = optimizer.solve()
+    assert result.status == 'Optimal'
+    devices = make_devices()
+    devices[2][1]['estimated_hourly_production'] = solar[0]
+    deterministic = EnergyOptimizer.from_devices(24, devices, backend='scipy')
+    deterministic.solve()
+    assert np.isclose(result.objective, deterministic.get_total_cost())
+    assert np.isclose(optimizer.get_expected_cost(), result.objective)
+
+
+def test_shared_first_steps_and_cvar():
+    solar = solar_ensemble(5, 24)
+    weights = [0.4, 0.3, 0.1, 0.1, 0.1]
+    optimizer = ScenarioOptimizer(24, make_devices(), {'solar': solar}, weights=weights, shared_steps=3)
+    result = optimizer.solve()
+    series = optimizer.get_time_series()
+    assert series['battery']['soc'].shape == (5, 24)
+    for var_name in ['charge_rate', 'discharge_rate']:
+        values = series['battery'][var_name]
+        assert np.allclose(values[:, :3], values[0, :3], atol=1e-5)
+        assert np.allclose(optimizer.get_first_step()['battery'][var_name], values[0, :3], atol=1e-5)
+    costs = optimizer.get_scenario_costs()
+    assert np.isclose(result.objective, np.dot(weights, costs))
+    # Each scenario is at least as expensive as if it were known in advance.
+    for scenario in range(5):
+        devices = make_devices()
+        devices[2][1]['estimated_hourly_production'] = solar[scenario]
+        deterministic = EnergyOptimizer.from_devices(24, devices, backend='scipy')
+        deterministic.solve()
+        assert costs[scenario] >= deterministic.get_total_cost() - 1e-6
+
+    risk_averse = ScenarioOptimizer(24, make_devices(), {'solar': solar}, weights=weights, shared_steps=24,
+        cvar_alpha=0.8, cvar_weight=10.0)
+    risk_averse.solve()
+    neutral = ScenarioOptimizer(24, make_devices(), {'solar': solar}, weights=weights, shared_steps=24)
+    neutral.solve()
+    assert risk_averse.get_cvar() <= neutral.get_cvar(0.8) + 1e-6
+    assert risk_averse.get_expected_cost() >= neutral.get_expected_cost() - 1e-6
+
+
+def test_scales_to_large_ensembles():
+    n_hours = 96
+    start = time.perf_counter()
+    optimizer = ScenarioOptimizer(n_hours, make_devices(n_hours, np.tile(prices, 4)), {'solar': solar_ensemble(50, n_hours)},
+        shared_steps=4, cvar_alpha=0.9, cvar_weight=1.0)
+    assert time.perf_counter() - start < 2.0
+    result = optimizer.solve()
+    assert result.has_solution
+    assert optimizer.stats.n_vars == 50 * 7 * 96 + 51
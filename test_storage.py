@@ -0,0 +1,68 @@
+from optim import EnergyOptimizer
+from storage import load_devices, load_plan, save_plan
+import os
+import subprocess
+import sys
+import numpy as np
+
+
+prices = [15, 18, 19, 10, 10, 10, 10, 10, 15, 15, 10, 12, 14, 15, 15, 13, 14, 12, 15, 14, 13, 11, 10, 13]
+
+
+def build():
+    optimizer = EnergyOptimizer(24)
+    optimizer.add_mains_electricity_supply(name='mains', max_import_power=10, import_hourly_prices=prices,
+        max_export_power=5, export_hourly_prices=np.array(prices) * 0.5)
+    optimizer.add_fixed_consumption(name='consumption', hourly_consumption=[1] * 24)
+    optimizer.add_battery('battery', 15, 10, 0.95, 5, 5, 1, 12, min_soc=2)
+    optimizer.add_heating_consumption(name='heatpump', max_heat_power=3.0, hourly_demand=[1.5] * 24, tol_cumul_min=-2,
+        tol_cumul_max=2, final_energy_value_per_kwh=12)
+    return optimizer
+
+
+def test_devices_round_trip(tmp_path):
+    optimizer = build()
+    optimizer.update_initial_soc('battery', 3)
+    optimizer.update_forecast('consumption', [2] * 24)
+    optimizer.solve()
+    path = tmp_path / 'config.npz'
+    optimizer.save(path)
+    config = load_devices(path)
+    assert config['n_hours'] == 24
+    assert [method_name for method_name, _ in config['devices']] == ['add_mains_electricity_supply', 'add_fixed_consumption',
+        'add_battery', 'add_heating_consumption']
+    # Positional arguments are stored by name, updated data replaces the original one.
+    assert config['devices'][2][1]['capacity'] == 15 and config['devices'][2][1]['initial_soc'] == 3
+    np.testing.assert_array_equal(config['devices'][1][1]['hourly_consumption'], [2] * 24)
+    loaded = EnergyOptimizer.load(path, backend='scipy')
+    loaded.solve()
+    assert np.isclose(loaded.get_total_cost(), optimizer.get_total_cost(), rtol=1e-6)
+
+
+def test_plan_round_trip(tmp_path):
+    optimizer = build()
+    optimizer.solve()
+    path = tmp_path / 'plan.npz'
+    optimizer.save_plan(path)
+    plan, metadata = load_plan(path, with_metadata=True)
+    series = optimizer.get_time_series()
+    assert plan.keys() == series.keys()
+    for device_name, device_series in series.items():
+        for var_name, values in device_series.items():
+            np.testing.assert_array_equal(plan[device_name][var_name], values)
+    assert np.isclose(metadata['objective'], optimizer.get_total_cost())
+    save_plan(tmp_path / 'copy.npz', plan)
+    assert load_plan(tmp_path / 'copy.npz')['battery']['soc'].dtype == np.float32
+
+
+def test_loading_does_not_import_pulp(tmp_path):
+    optimizer = build()
+    optimizer.solve()
+    optimizer.save(tmp_path / 'config.npz')
+    optimizer.save_plan(tmp_path / 'plan.npz')
+    # With the pulp backend pulp is imported only when the loaded model is solved.
+    code = ("import sys, storage, optim; storage.load_plan(sys.argv[1]); storage.load_devices(sys.argv[2]); "
+        "optim.EnergyOptimizer.load(sys.argv[2], backend='scipy'); optimizer = optim.EnergyOptimizer.load(sys.argv[2]); "
+        "assert 'pulp' not in sys.modules; optimizer.solve(); assert 'pulp' in sys.modules")
+    subprocess.run([sys.executable, '-c', code, str(tmp_path / 'plan.npz'), str(tmp_path / 'config.npz')], check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)))